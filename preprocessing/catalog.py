@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+Persistent catalog of the converted logs.
+
+Every converted log is recorded in a SQLite database next to the converted
+logs with its file, number of rows, mission duration and columns, along
+with its annotation status. The converter records logs as it converts
+them and the server hands out the logs to annotate from the catalog,
+marking them annotated as they are saved, so neither has to scan the log
+directories or open a log to know about it.
+
+Running this file records the logs of the directory the catalog does not
+know about yet (e.g. logs converted before the catalog existed or
+migrated to another format) and drops the logs whose file is gone,
+
+    python3 preprocessing/catalog.py
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+import pandas as pd
+from typing import Iterable, List, Tuple
+
+from storage import list_logs, log_name, read_df
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+# logs the server failed to read, handed out again once converted again
+FAILED = "failed"
+
+schema = f"""
+CREATE TABLE IF NOT EXISTS logs (
+    log_id TEXT PRIMARY KEY,
+    file TEXT NOT NULL UNIQUE,
+    num_rows INTEGER NOT NULL,
+    duration_s REAL,
+    columns TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT '{PENDING}',
+    annotator TEXT,
+    lease TEXT,
+    lease_expires REAL
+);
+CREATE INDEX IF NOT EXISTS logs_status ON logs(status, lease_expires);
+"""
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    # the converter workers and the server processes write concurrently.
+    # WAL needs shared memory, they all have to run on the host storing the
+    # catalog, not over a network filesystem
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(schema)
+    return conn
+
+
+def describe(df: pd.DataFrame) -> Tuple[int, float | None, List[str]]:
+    """
+    returns the number of rows, the duration in seconds (from the timestamp
+    column in microseconds, if any) and the columns of a log
+    """
+    duration_s = None
+    if "timestamp" in df and df.shape[0] > 0:
+        timestamp = df["timestamp"].to_numpy()
+        duration_s = float(timestamp[-1] - timestamp[0]) / 1e6
+    return df.shape[0], duration_s, list(df.columns)
+
+
+def record_log(conn: sqlite3.Connection, path: str, df: pd.DataFrame) -> None:
+    """
+    records a converted log, a log converted again keeps its annotation
+    status unless the server failed to read it
+    """
+    num_rows, duration_s, columns = describe(df)
+    with conn:
+        conn.execute(
+            f"""
+            INSERT INTO logs (log_id, file, num_rows, duration_s, columns)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (log_id) DO UPDATE SET
+                file = excluded.file,
+                num_rows = excluded.num_rows,
+                duration_s = excluded.duration_s,
+                columns = excluded.columns,
+                status = CASE WHEN status = '{FAILED}' THEN '{PENDING}'
+                    ELSE status END
+            """,
+            (
+                log_name(path),
+                os.path.basename(path),
+                num_rows,
+                duration_s,
+                json.dumps(columns),
+            ),
+        )
+
+
+def has_log(conn: sqlite3.Connection, path: str) -> bool:
+    """
+    returns whether the log file is recorded under its current name
+    """
+    row = conn.execute(
+        "SELECT 1 FROM logs WHERE file = ?", (os.path.basename(path),)
+    ).fetchone()
+    return row is not None
+
+
+def is_annotated(conn: sqlite3.Connection, log_id: str) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM logs WHERE log_id = ? AND status = ?", (log_id, DONE)
+    ).fetchone()
+    return row is not None
+
+
+def remove_log(conn: sqlite3.Connection, log_id: str) -> None:
+    """
+    drops a log that is no longer converted, annotated logs are kept
+    """
+    with conn:
+        conn.execute(
+            "DELETE FROM logs WHERE log_id = ? AND status != ?", (log_id, DONE)
+        )
+
+
+def mark_annotated(conn: sqlite3.Connection, log_ids: Iterable[str]) -> None:
+    with conn:
+        conn.executemany(
+            "UPDATE logs SET status = ?, lease = NULL WHERE log_id = ?",
+            ((DONE, log_id) for log_id in log_ids),
+        )
+
+
+def count_logs(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT count(*) FROM logs").fetchone()[0]
+
+
+def scan(conn: sqlite3.Connection, dir: str) -> int:
+    """
+    records the logs of `dir` that are not recorded under their current
+    file name and drops the unannotated logs whose file is gone, returns
+    the number of recorded logs
+    """
+    paths = list_logs(dir)
+    files = set(map(os.path.basename, paths))
+    n_recorded = 0
+    for path in paths:
+        if has_log(conn, path):
+            continue
+        record_log(conn, path, read_df(path))
+        n_recorded += 1
+    gone = [
+        (log_id,)
+        for log_id, file in conn.execute(
+            "SELECT log_id, file FROM logs WHERE status != ?", (DONE,)
+        )
+        if file not in files
+    ]
+    with conn:
+        conn.executemany("DELETE FROM logs WHERE log_id = ?", gone)
+    return n_recorded
+
+
+def main():
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Record converted logs")
+    parser.add_argument(
+        "dir",
+        nargs="?",
+        default=os.path.join(cwd, "../data/csv_files"),
+        help="directory of the converted logs",
+    )
+    args = parser.parse_args()
+
+    conn = connect(os.path.join(args.dir, "catalog.sqlite"))
+    n_recorded = scan(conn, args.dir)
+    print(f"Recorded {n_recorded} logs, {count_logs(conn)} in the catalog")
+
+
+if __name__ == "__main__":
+    main()
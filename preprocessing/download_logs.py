@@ -23,8 +23,15 @@ import json
 import datetime
 import sys
 import time
+import heapq
+import random
+import threading
 import yaml
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import log_db
+from manifest import load_manifest, save_manifest
 
 # configuration tables (map modes and errors to IDs)
 
@@ -94,137 +101,379 @@ def error_labels_to_ids(error_labels):
     return error_ids
 
 
-""" main script entry point """
+# folders used by the script, relative to the script's directory
+db_info_dir = os.path.join(os.path.pardir, "data", "database_info_files")
+download_folder = os.path.join(os.path.pardir, "data", "ulg_files")
+csv_folder = os.path.join(os.path.pardir, "data", "csv_files")
+failed_logs_path = os.path.join(db_info_dir, "failed_logs.json")
+log_db_path = os.path.join(db_info_dir, "px4_db_info.sqlite")
 
-# change the working directory to be the script's directory
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
+# logs are streamed and written in 1 MB chunks
+chunk_size = 1 << 20
 
-# read the user arguments (including filters for log download)
-with open("downloader_options.yaml", "r") as stream:
-    arguments = yaml.safe_load(stream)
+# every ULog file starts with a 16 bytes header beginning with this magic
+ulog_magic = b"ULog\x01\x12\x35"
+ulog_header_size = 16
 
-# create a folder to store database info files
-db_info_dir = os.path.join(os.path.pardir, "data", "database_info_files")
-if not os.path.isdir(db_info_dir):
-    os.makedirs(db_info_dir)
-
-# if the user has a database info file, use it
-db_entries_list = []
-if arguments["use_local_db_info"]:
-    db_file = arguments["local_db_info_file"]
-    db_path = os.path.join(db_info_dir, db_file)
-    if os.path.isfile(db_path):
-        with open(db_path, "r") as fin:
-            db_entries_list = json.load(fin)
+
+def read_arguments():
+    """
+    returns the user arguments (including filters for log download)
+    """
+    with open("downloader_options.yaml", "r") as stream:
+        return yaml.safe_load(stream)
+
+
+def get_db_info(arguments):
+    """
+    makes sure the public database entries are ingested in the local log
+    database and returns a connection to it along with the name of the
+    database info file they were read from or saved to, and the source
+    their logs are recorded under
+    """
+    # create a folder to store database info files
+    if not os.path.isdir(db_info_dir):
+        os.makedirs(db_info_dir)
+    conn = log_db.connect(log_db_path)
+
+    # if the user has a database info file, use it
+    if arguments["use_local_db_info"]:
+        db_file = arguments["local_db_info_file"]
+        db_path = os.path.join(db_info_dir, db_file)
+        source = os.path.basename(db_path)
+        if not os.path.isfile(db_path):
+            print("didn't find the database info file")
+            exit()
+        # the json file is only parsed the first time it is used
+        if not log_db.is_ingested(conn, db_path):
+            print("ingesting database info file ..")
+            log_db.ingest(conn, db_path)
+
+    # or only merge the entries that changed since the last sync
+    elif arguments.get("incremental_db_info_sync"):
+        db_file = "px4_db_info_sync.json"
+        source = arguments["db_api_info"]
+        print("attempting to sync database info ..")
+        try:
+            sync_db_info(conn, arguments["db_api_info"])
+        except Exception as ex:
+            print(ex)
+            print("Server request failed, retry later")
+            sys.exit()
+
+    # or download the updated database info and save it
     else:
-        print("didn't find the database info file")
-        exit()
-
-# or download the updated database info and save it
-else:
-    db_file = "px4_db_info_" + datetime.datetime.now().strftime("%d%b%Y") + ".json"
-    db_path = os.path.join(db_info_dir, db_file)
-    print("attempting to download database info file ..")
-    try:
-        # the db_info_api sends a json file with a list of all public database entries
-        db_entries_list = requests.get(url=arguments["db_api_info"]).json()
-        print("downloaded database info, saving ...")
-        with open(db_path, "w") as fout:
-            json.dump(db_entries_list, fout, indent=4)
-        print("saved downloaded database")
-    except:
-        print("Server request failed, retry later")
-        sys.exit()
-
-print("\ndatabase info retreived!, number of logs : ", len(db_entries_list))
-
-# find already existing logs in download folder (a log id is 36 characters)
-download_folder = os.path.join(os.path.pardir, "data", "ulg_files")
-if os.path.isdir(download_folder):
-    lognames = sorted(os.listdir(download_folder))
-    logfiles = [log_name[-40:-4] for log_name in lognames]
-    existing_logs = frozenset(logfiles)
-    print("found", len(existing_logs), "logs in the download folder")
-else:
-    print("no logs folder found, just created")
-    existing_logs = frozenset([])
-    os.makedirs(download_folder)
-
-# filter logs for flight duration
-if arguments["duration_max_m"] is not None and arguments["duration_min_m"] is not None:
-    db_entries_list = [
-        entry
-        for entry in db_entries_list
-        if entry["duration_s"] > arguments["duration_min_m"] * 60
-        and entry["duration_s"] < arguments["duration_max_m"] * 60
-    ]
-
-    print("\nfiltered flight duration, number of remaining logs:", len(db_entries_list))
-
-# apply other filters defined in downloader_options.yaml -> filters (including mav_type, flight_modes ... etc)
-for filter_name, filter_values in arguments["filters"].items():
-    if filter_values is not None:
-        if filter_name == "flight_modes":
-            # use modes ids
-            filter_values = flight_modes_to_ids(filter_values)
-            # keep any log that contains any of the given modes
-            db_entries_list = [
-                entry
-                for entry in db_entries_list
-                if (set(entry[filter_name]) & set(filter_values))
-            ]
-        elif filter_name == "num_logged_errors":
-            # only keep logs with the required number of errors (zero is recommended)
-            db_entries_list = [
-                entry
-                for entry in db_entries_list
-                if entry[filter_name] == filter_values
-            ]
-        else:
-            # for any other filter keep any log that satisfies any filter value
-            # for example, if multiple hardware allowed, keep logs that use any of them
-            filter_values = [value.lower() for value in filter_values]
-            db_entries_list = [
-                entry
-                for entry in db_entries_list
-                if entry[filter_name].lower() in filter_values
-            ]
-
-        print(
-            "filtered for",
-            filter_name,
-            ",  number of remaining logs:",
-            len(db_entries_list),
+        db_file = (
+            "px4_db_info_" + datetime.datetime.now().strftime("%d%b%Y") + ".json"
+        )
+        db_path = os.path.join(db_info_dir, db_file)
+        source = db_file
+        print("attempting to download database info file ..")
+        try:
+            # the db_info_api sends a json file with a list of all public database entries
+            db_entries_list = requests.get(url=arguments["db_api_info"]).json()
+            print("downloaded database info, saving ...")
+            with open(db_path, "w") as fout:
+                json.dump(db_entries_list, fout)
+            log_db.upsert_entries(conn, db_entries_list)
+            log_db.record_source(
+                conn, db_path, [entry["log_id"] for entry in db_entries_list]
+            )
+            print("saved downloaded database")
+        except:
+            print("Server request failed, retry later")
+            sys.exit()
+
+    print("\ndatabase info retreived!, number of logs : ", log_db.count_entries(conn))
+    return conn, db_file, source
+
+
+def sync_db_info(conn, url):
+    """
+    downloads the database info unless it hasn't changed since the last sync
+    (conditional request) and merges the new and changed entries into the
+    local log database
+    """
+    response = requests.get(
+        url=url, headers=log_db.sync_headers(conn, url), timeout=600
+    )
+    if response.status_code == 304:
+        print("database info unchanged since the last sync")
+        return
+    response.raise_for_status()
+
+    entries = response.json()
+    new_ids, changed_ids = log_db.merge_entries(conn, entries)
+    log_db.set_source_logs(conn, url, [entry["log_id"] for entry in entries])
+    log_db.record_sync(
+        conn,
+        url,
+        response.headers.get("ETag"),
+        response.headers.get("Last-Modified"),
+        new_ids + changed_ids,
+    )
+    print(
+        "synced database info, {:} new logs, {:} changed logs".format(
+            len(new_ids), len(changed_ids)
+        )
+    )
+
+
+def log_id_of(file_name):
+    """
+    returns the log id of a downloaded log file (a log id is 36 characters),
+    raw logs may have been compressed after conversion
+    """
+    file_name = os.path.basename(file_name)
+    if file_name.endswith(".gz"):
+        file_name = file_name[:-3]
+    return file_name[-40:-4]
+
+
+def find_existing_logs():
+    """
+    returns the ids of the logs already in the download folder, or already
+    converted by ulog2csv.py after their raw file was removed
+    """
+    if os.path.isdir(download_folder):
+        # hidden files are partial downloads
+        lognames = sorted(
+            name for name in os.listdir(download_folder) if not name.startswith(".")
         )
+        logfiles = [log_id_of(log_name) for log_name in lognames]
+        print("found", len(logfiles), "logs in the download folder")
+    else:
+        print("no logs folder found, just created")
+        logfiles = []
+        os.makedirs(download_folder)
+
+    manifest_path = os.path.join(csv_folder, "manifest.json")
+    converted = [log_id_of(log_name) for log_name in load_manifest(manifest_path)]
+    return frozenset(logfiles + converted)
+
+
+def filter_entries(conn, arguments, source):
+    """
+    returns the database entries of the database info `source` that pass the
+    filters in downloader_options.yaml, shortest logs first
+    """
+    # filters run as a query on the indexed log database, flight modes are
+    # matched by their ids
+    filters = dict(arguments["filters"])
+    if filters.get("flight_modes") is not None:
+        filters["flight_modes"] = flight_modes_to_ids(filters["flight_modes"])
+    duration_min_s = duration_max_s = None
+    if (
+        arguments["duration_max_m"] is not None
+        and arguments["duration_min_m"] is not None
+    ):
+        duration_min_s = arguments["duration_min_m"] * 60
+        duration_max_s = arguments["duration_max_m"] * 60
+    # only keep the logs added or changed by the last sync if required
+    generation = None
+    if arguments.get("incremental_db_info_sync") and arguments.get("only_new_logs"):
+        generation = log_db.sync_generation(conn, arguments["db_api_info"])
+    db_entries_list = log_db.query_entries(
+        conn, source, duration_min_s, duration_max_s, filters, generation
+    )
+    print("\nfiltered logs, number of remaining logs:", len(db_entries_list))
 
-# remove simulated logs from qground station
-db_entries_list = [
-    entry for entry in db_entries_list if entry["source"] != "QGroundControl"
-]
-print("removed simulated logs,  number of remaining logs: ", len(db_entries_list))
-print("")
+    # remove logs that ulog2csv.py already rejected, they would be rejected again
+    if arguments.get("skip_rejected_logs"):
+        rejected_path = os.path.join(csv_folder, "rejected.json")
+        rejected_ids = {
+            entry["log_id"] for entry in load_manifest(rejected_path).values()
+        }
+        db_entries_list = [
+            entry for entry in db_entries_list if entry["log_id"] not in rejected_ids
+        ]
+        print("removed rejected logs, number of remaining logs:", len(db_entries_list))
+    print("")
 
-# sort list to first download the shortest logs
-db_entries_list = sorted(db_entries_list, key=lambda x: x["duration_s"])
+    return db_entries_list
 
-# save the filtered db file
-filtered_db_file = "filtered_" + db_file
-filtered_db_path = os.path.join(db_info_dir, filtered_db_file)
-with open(filtered_db_path, "w") as fout:
-    json.dump(db_entries_list, fout, indent=4)
-    print("saved filtered db\n")
 
-# download the log files if required
-if not arguments["save_db_info_only"]:
+class RateLimiter:
+    """
+    spaces out the requests of all download threads so that at most `rate`
+    requests start per second, a rate of 0 disables the limit
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Progress:
+    """
+    aggregate download throughput and ETA over all download threads
+    """
+
+    def __init__(self, num_logs):
+        self.num_logs = num_logs
+        self.num_done = 0
+        self.num_bytes = 0
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, log_name, num_bytes, status="downloaded"):
+        with self.lock:
+            self.num_done += 1
+            self.num_bytes += num_bytes
+            elapsed = time.monotonic() - self.start_time
+            rate = self.num_bytes / elapsed / 2**20 if elapsed else 0
+            eta = elapsed / self.num_done * (self.num_logs - self.num_done)
+            print(
+                "{:} {:}/{:} ({:}), {:.2f} MB/s, ETA {:}".format(
+                    status,
+                    self.num_done,
+                    self.num_logs,
+                    log_name,
+                    rate,
+                    datetime.timedelta(seconds=round(eta)),
+                )
+            )
+
+
+def make_session(concurrency):
+    """
+    returns a session whose connection pool is shared by all download threads
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def check_log(file_path, size):
+    """
+    raises if a downloaded log doesn't have the expected size or doesn't
+    start with a ULog header
+    """
+    actual_size = os.path.getsize(file_path)
+    if size is not None and actual_size != size:
+        raise IOError(f"Downloaded {actual_size} of {size} bytes")
+    with open(file_path, "rb") as log_file:
+        header = log_file.read(ulog_header_size)
+    if len(header) < ulog_header_size or not header.startswith(ulog_magic):
+        raise IOError("Downloaded file is not a ULog file")
+
+
+def fetch_log(session, limiter, url, file_path):
+    """
+    streams a single log to a hidden partial file, resuming an earlier
+    partial download with a Range request, and renames it to file_path once
+    it is complete, returns the number of bytes downloaded
+    """
+    part_path = os.path.join(
+        os.path.dirname(file_path), "." + log_id_of(file_path) + ".part"
+    )
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    limiter.wait()
+    num_bytes = 0
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        if offset and response.status_code == 416:
+            # the partial file doesn't fit the log (e.g. it was complete but
+            # a killed run never renamed it), start over right away
+            os.remove(part_path)
+            return fetch_log(session, limiter, url, file_path)
+        response.raise_for_status()
+
+        # the expected size is unknown when the body is content encoded,
+        # since requests decodes it while streaming
+        size = None
+        encoded = response.headers.get("Content-Encoding", "identity") != "identity"
+        if response.status_code == 206:
+            # Content-Range is "bytes <first>-<last>/<total or *>"
+            content_range = response.headers.get("Content-Range", "")
+            first = content_range.removeprefix("bytes ").split("-")[0]
+            if first != str(offset):
+                # the body would not continue the partial file
+                os.remove(part_path)
+                return fetch_log(session, limiter, url, file_path)
+            total = content_range.split("/")[-1]
+            size = None if encoded or total == "*" else int(total)
+            mode = "ab"
+        else:
+            # the server ignored the range, the whole log is sent again
+            length = response.headers.get("Content-Length")
+            size = None if encoded or length is None else int(length)
+            mode = "wb"
+
+        with open(part_path, mode, buffering=chunk_size) as log_file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:  # filter out keep-alive new chunks
+                    log_file.write(chunk)
+                    num_bytes += len(chunk)
+
+    try:
+        check_log(part_path, size)
+    except IOError:
+        os.remove(part_path)
+        raise
+    os.replace(part_path, file_path)
+    return num_bytes
+
+
+def is_permanent(ex):
+    """
+    returns whether a download error will happen again on every try, client
+    errors other than timeouts, rate limiting and an unsatisfiable resume
+    range mean the log can't be fetched
+    """
+    if not isinstance(ex, requests.HTTPError) or ex.response is None:
+        return False
+    status = ex.response.status_code
+    return 400 <= status < 500 and status not in [408, 416, 425, 429]
+
+
+def backoff_delay(arguments, num_tries):
+    """
+    returns the delay before the next try of a log that failed `num_tries`
+    times, exponential with full jitter so failing logs don't retry in sync
+    """
+    cap = min(
+        arguments.get("download_backoff_max_s", 600),
+        arguments.get("download_backoff_s", 5) * 2**num_tries,
+    )
+    return random.uniform(0, cap)
+
+
+def download_logs(db_entries_list, arguments, existing_logs, on_log=None):
+    """
+    downloads the logs in db_entries_list to the download folder using
+    `download_concurrency` threads that share one connection pool, `on_log`
+    is called with the path of every log once it has been downloaded.
+
+    A log that fails is parked in a deferred queue with an exponential
+    backoff while the other logs keep downloading, and is given up after
+    `download_retries` tries. Logs that fail permanently (404 and other
+    client errors) are recorded and not tried again on the next runs.
+    """
+    failed_logs = load_manifest(failed_logs_path)
 
     # set number of files to download
     max_num_logs = len(db_entries_list)
     if arguments["max_num"] > 0:
         max_num_logs = min(max_num_logs, arguments["max_num"])
-    n_downloaded = 0
     n_skipped = 0
 
-    # loop on the db info list (logs)
+    # name the logs and leave out the existing ones
+    to_download = []
     for log_num, log in enumerate(db_entries_list[:max_num_logs]):
         entry_id = log["log_id"]
         log_duration = log["duration_s"] / 60
@@ -236,43 +485,111 @@ if not arguments["save_db_info_only"]:
             + entry_id
             + ".ulg"
         )
-
-        num_tries = 0
-        for num_tries in range(100):
-            try:
-                if arguments["overwrite"] or entry_id not in existing_logs:
-
-                    file_path = os.path.join(download_folder, log_name)
-
+        if entry_id in failed_logs:
+            print("skipping", log_name, ", failed permanently before")
+            n_skipped += 1
+        elif arguments["overwrite"] or entry_id not in existing_logs:
+            to_download.append((entry_id, log_name))
+        else:
+            print("skipping", log_name, ", already existing")
+            n_skipped += 1
+
+    concurrency = arguments.get("download_concurrency") or 1
+    max_tries = arguments.get("download_retries", 8)
+    session = make_session(concurrency)
+    limiter = RateLimiter(arguments.get("download_rate_limit"))
+    progress = Progress(len(to_download))
+
+    def download(entry_id, log_name):
+        file_path = os.path.join(download_folder, log_name)
+        url = arguments["download_api"] + "?log=" + entry_id
+        num_bytes = fetch_log(session, limiter, url, file_path)
+        progress.update(log_name, num_bytes)
+        if on_log is not None:
+            on_log(file_path)
+
+    # logs waiting for their next try as (ready time, order, number of
+    # failed tries, log id, log name), fresh logs are ready right away
+    deferred = [(0.0, i, 0, *log) for i, log in enumerate(to_download)]
+    heapq.heapify(deferred)
+    running = {}
+    n_failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while deferred or running:
+            # keep every thread busy with the logs that are ready
+            now = time.monotonic()
+            while deferred and deferred[0][0] <= now and len(running) < concurrency:
+                _, order, num_tries, entry_id, log_name = heapq.heappop(deferred)
+                future = executor.submit(download, entry_id, log_name)
+                running[future] = (order, num_tries, entry_id, log_name)
+
+            # wait for a download to finish or the next deferred log
+            timeout = None
+            if deferred and len(running) < concurrency:
+                timeout = max(deferred[0][0] - now, 0)
+            if not running:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                order, num_tries, entry_id, log_name = running.pop(future)
+                ex = future.exception()
+                if ex is None:
+                    continue
+                num_tries += 1
+                if is_permanent(ex):
+                    print("failed", log_name, ":", ex, ", not retrying")
+                    failed_logs[entry_id] = {
+                        "status": ex.response.status_code,
+                        "error": str(ex),
+                        "time": datetime.datetime.now().isoformat(),
+                    }
+                    save_manifest(failed_logs_path, failed_logs)
+                elif num_tries >= max_tries:
+                    print("failed", log_name, ":", ex, ", retries exhausted")
+                else:
+                    delay = backoff_delay(arguments, num_tries)
                     print(
-                        "downloading {:}/{:} ({:})".format(
-                            log_num + 1, max_num_logs, log_name
+                        "failed {:} : {:}, retrying in {:.0f} seconds".format(
+                            log_name, ex, delay
                         )
                     )
-                    request = requests.get(
-                        url=arguments["download_api"] + "?log=" + entry_id, stream=True
+                    ready_time = time.monotonic() + delay
+                    heapq.heappush(
+                        deferred, (ready_time, order, num_tries, entry_id, log_name)
                     )
-                    with open(file_path, "wb") as log_file:
-                        for chunk in request.iter_content(chunk_size=1024):
-                            if chunk:  # filter out keep-alive new chunks
-                                log_file.write(chunk)
-                    n_downloaded += 1
-
-                else:
-                    print("skipping", log_name, ", already existing")
-                    n_skipped += 1
-
-                break
-            except Exception as ex:
-                print(ex)
-                print("Waiting for 30 seconds to retry")
-                time.sleep(30)
-        if num_tries == 99:
-            print("Retried", str(num_tries + 1), "times without success, exiting.")
-            sys.exit(1)
+                    continue
+                n_failed += 1
+                progress.update(log_name, 0, "failed")
 
     print(
-        "{:} logs downloaded to {:}, skipped {:}".format(
-            n_downloaded, download_folder, n_skipped
+        "{:} logs downloaded to {:}, skipped {:}, failed {:}".format(
+            len(to_download) - n_failed, download_folder, n_skipped, n_failed
         )
     )
+
+
+def main():
+    # change the working directory to be the script's directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    arguments = read_arguments()
+    conn, db_file, source = get_db_info(arguments)
+    existing_logs = find_existing_logs()
+    db_entries_list = filter_entries(conn, arguments, source)
+
+    # save the filtered db file
+    filtered_db_file = "filtered_" + db_file
+    filtered_db_path = os.path.join(db_info_dir, filtered_db_file)
+    with open(filtered_db_path, "w") as fout:
+        json.dump(db_entries_list, fout)
+        print("saved filtered db\n")
+
+    # download the log files if required
+    if not arguments["save_db_info_only"]:
+        download_logs(db_entries_list, arguments, existing_logs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""
+Indexed SQLite store of the PX4 flight review database info.
+
+The db info json lists every public log, parsing and filtering it takes a
+long time, so it is ingested once into a SQLite database with indexes on
+the fields the downloader filters on. Filters are then run as queries.
+Every log is stored with its full json entry, so fields without a column
+of their own can still be filtered on through json_extract.
+
+Every db info file (or sync) the logs were read from is recorded along
+with its logs, so queries only return the logs of the db info in use.
+
+The db info can also be synced incrementally, the ETag/Last-Modified of
+the last sync are kept for conditional requests and every sync that adds
+or changes logs bumps a generation recorded for those logs, so the logs
+new since the last sync can be queried.
+"""
+
+import os
+import json
+import sqlite3
+from typing import Any, Dict, Iterable, List, Tuple
+
+# fields of a db info entry that get their own indexed column, string fields
+# are matched case insensitively through an index on their lowered value
+columns = {
+    "duration_s": "REAL",
+    "num_logged_errors": "INTEGER",
+    "sys_hw": "TEXT",
+    "mav_type": "TEXT",
+    "rating": "TEXT",
+    "source": "TEXT",
+}
+
+schema = f"""
+CREATE TABLE IF NOT EXISTS logs (
+    log_id TEXT PRIMARY KEY,
+    {", ".join(f"{name} {type}" for name, type in columns.items())},
+    entry TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS flight_modes (
+    log_id TEXT NOT NULL,
+    mode INTEGER NOT NULL,
+    PRIMARY KEY (mode, log_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS flight_modes_log_id ON flight_modes(log_id);
+CREATE INDEX IF NOT EXISTS logs_duration_s ON logs(duration_s);
+CREATE INDEX IF NOT EXISTS logs_num_logged_errors ON logs(num_logged_errors);
+CREATE INDEX IF NOT EXISTS logs_sys_hw ON logs(lower(sys_hw));
+CREATE INDEX IF NOT EXISTS logs_mav_type ON logs(lower(mav_type));
+CREATE INDEX IF NOT EXISTS logs_rating ON logs(lower(rating));
+CREATE TABLE IF NOT EXISTS sources (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS source_logs (
+    source TEXT NOT NULL,
+    log_id TEXT NOT NULL,
+    PRIMARY KEY (source, log_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS syncs (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    log_id TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_generation ON changes(generation);
+"""
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    conn.executescript(schema)
+    return conn
+
+
+def is_ingested(conn: sqlite3.Connection, json_path: str) -> bool:
+    """
+    returns whether the db info json file has already been ingested and has
+    not changed since
+    """
+    stat = os.stat(json_path)
+    row = conn.execute(
+        "SELECT size, mtime_ns FROM sources WHERE name = ?",
+        (os.path.basename(json_path),),
+    ).fetchone()
+    # files ingested before their logs were recorded are ingested again
+    return row == (stat.st_size, stat.st_mtime_ns) and has_source(
+        conn, os.path.basename(json_path)
+    )
+
+
+def has_source(conn: sqlite3.Connection, source: str) -> bool:
+    """
+    returns whether the logs of the db info `source` are recorded
+    """
+    row = conn.execute(
+        "SELECT 1 FROM source_logs WHERE source = ? LIMIT 1", (source,)
+    ).fetchone()
+    return row is not None
+
+
+def set_source_logs(
+    conn: sqlite3.Connection, source: str, log_ids: Iterable[str]
+) -> None:
+    """
+    records the logs listed by the db info `source`, replacing the ones
+    recorded before
+    """
+    with conn:
+        conn.execute("DELETE FROM source_logs WHERE source = ?", (source,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO source_logs VALUES (?, ?)",
+            ((source, log_id) for log_id in log_ids),
+        )
+
+
+def upsert_entries(conn: sqlite3.Connection, entries: List[Dict[str, Any]]) -> None:
+    """
+    inserts the db info entries, replacing the stored entries of the same
+    log ids
+    """
+    with conn:
+        marks = ", ".join("?" * (len(columns) + 2))
+        conn.executemany(
+            f"INSERT OR REPLACE INTO logs VALUES ({marks})",
+            (
+                [entry["log_id"]]
+                + [entry.get(name) for name in columns]
+                + [json.dumps(entry, sort_keys=True)]
+                for entry in entries
+            ),
+        )
+        conn.executemany(
+            "DELETE FROM flight_modes WHERE log_id = ?",
+            ((entry["log_id"],) for entry in entries),
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO flight_modes VALUES (?, ?)",
+            (
+                (entry["log_id"], mode)
+                for entry in entries
+                for mode in entry.get("flight_modes") or []
+            ),
+        )
+
+
+def ingest(conn: sqlite3.Connection, json_path: str) -> int:
+    """
+    ingests a db info json file and records it so it is only ingested again
+    once it changes, returns the number of ingested entries
+    """
+    with open(json_path, "r") as fin:
+        entries = json.load(fin)
+    upsert_entries(conn, entries)
+    record_source(conn, json_path, [entry["log_id"] for entry in entries])
+    return len(entries)
+
+
+def record_source(
+    conn: sqlite3.Connection, json_path: str, log_ids: Iterable[str]
+) -> None:
+    """
+    records that the entries of a db info json file have been ingested,
+    along with the logs it lists
+    """
+    stat = os.stat(json_path)
+    set_source_logs(conn, os.path.basename(json_path), log_ids)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+            (os.path.basename(json_path), stat.st_size, stat.st_mtime_ns),
+        )
+
+
+def merge_entries(
+    conn: sqlite3.Connection, entries: List[Dict[str, Any]]
+) -> Tuple[List[str], List[str]]:
+    """
+    stores the entries that are new or differ from the stored ones and
+    returns the ids of the new and of the changed logs
+    """
+    stored = dict(conn.execute("SELECT log_id, entry FROM logs"))
+    new_ids, changed_ids, merged = [], [], []
+    for entry in entries:
+        log_id = entry["log_id"]
+        if log_id not in stored:
+            new_ids.append(log_id)
+        elif stored[log_id] != json.dumps(entry, sort_keys=True):
+            changed_ids.append(log_id)
+        else:
+            continue
+        merged.append(entry)
+    upsert_entries(conn, merged)
+    return new_ids, changed_ids
+
+
+def sync_headers(conn: sqlite3.Connection, url: str) -> Dict[str, str]:
+    """
+    returns the conditional request headers for the next sync of `url`, a
+    sync whose logs are not recorded is downloaded in full
+    """
+    if not has_source(conn, url):
+        return {}
+    row = conn.execute(
+        "SELECT etag, last_modified FROM syncs WHERE url = ?", (url,)
+    ).fetchone()
+    headers = {}
+    if row is not None and row[0]:
+        headers["If-None-Match"] = row[0]
+    if row is not None and row[1]:
+        headers["If-Modified-Since"] = row[1]
+    return headers
+
+
+def sync_generation(conn: sqlite3.Connection, url: str) -> int | None:
+    """
+    returns the generation of the last sync of `url` that added or changed
+    logs, or None if it was never synced
+    """
+    row = conn.execute("SELECT generation FROM syncs WHERE url = ?", (url,)).fetchone()
+    return None if row is None else row[0]
+
+
+def record_sync(
+    conn: sqlite3.Connection,
+    url: str,
+    etag: str | None,
+    last_modified: str | None,
+    log_ids: List[str],
+) -> None:
+    """
+    records the validators of a sync of `url`, a sync that added or changed
+    `log_ids` starts a new generation made of those logs
+    """
+    generation = sync_generation(conn, url) or 0
+    if log_ids:
+        generation += 1
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?)",
+            (url, etag, last_modified, generation),
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO changes VALUES (?, ?)",
+            ((log_id, generation) for log_id in log_ids),
+        )
+
+
+def count_entries(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT count(*) FROM logs").fetchone()[0]
+
+
+def query_entries(
+    conn: sqlite3.Connection,
+    source: str,
+    duration_min_s: float | None,
+    duration_max_s: float | None,
+    filters: Dict[str, Any],
+    generation: int | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    returns the entries of the non simulated logs of the db info `source`
+    within the duration range that pass the filters, shortest logs first.
+    flight_modes filters hold mode ids and keep logs with any of the modes,
+    num_logged_errors keeps logs with exactly that many errors and every
+    other filter keeps logs whose value is any of the filter values (case
+    insensitive). With a `generation` only the logs added or changed by that
+    sync are returned
+    """
+    # remove simulated logs from qground station, logs without a source are
+    # kept
+    clauses = [
+        "source IS NOT 'QGroundControl'",
+        "log_id IN (SELECT log_id FROM source_logs WHERE source = ?)",
+    ]
+    params = [source]
+    if generation is not None:
+        clauses.append("log_id IN (SELECT log_id FROM changes WHERE generation = ?)")
+        params.append(generation)
+    if duration_min_s is not None and duration_max_s is not None:
+        clauses.append("duration_s > ? AND duration_s < ?")
+        params += [duration_min_s, duration_max_s]
+
+    for filter_name, filter_values in filters.items():
+        if filter_values is None:
+            continue
+        if filter_name == "num_logged_errors":
+            clauses.append("num_logged_errors = ?")
+            params.append(filter_values)
+            continue
+        marks = ", ".join("?" * len(filter_values))
+        if filter_name == "flight_modes":
+            clauses.append(
+                f"log_id IN (SELECT log_id FROM flight_modes WHERE mode IN ({marks}))"
+            )
+            params += filter_values
+            continue
+        if filter_name in columns:
+            clauses.append(f"lower({filter_name}) IN ({marks})")
+        else:
+            clauses.append(f"lower(json_extract(entry, ?)) IN ({marks})")
+            params.append(f'$."{filter_name}"')
+        params += [value.lower() for value in filter_values]
+
+    rows = conn.execute(
+        f"SELECT entry FROM logs WHERE {' AND '.join(clauses)} ORDER BY duration_s",
+        params,
+    )
+    return [json.loads(entry) for entry, in rows]
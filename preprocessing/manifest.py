@@ -0,0 +1,143 @@
+"""
+Manifest of converted logs used to only redo stale or missing outputs.
+
+Every converted log has an entry recording the ulog file it was converted
+from (size, mtime and sha256), the fingerprint of the extraction spec it
+was converted with, the file it was written to (size and sha256) and its
+native rate pyramid file (size).
+
+Logs rejected by the converter are recorded in a separate rejection index
+with the reason and the spec fingerprint they were rejected with, so they
+are not parsed again until the spec or the ulog file changes.
+"""
+
+import os
+import json
+import hashlib
+from typing import Any, Dict, TypedDict
+
+
+class ManifestEntry(TypedDict):
+    input_size: int
+    input_mtime_ns: int
+    input_sha256: str
+    spec: str
+    output: str
+    output_size: int
+    output_sha256: str
+    pyramid: str
+    pyramid_size: int
+
+
+class RejectedEntry(TypedDict):
+    log_id: str
+    reason: str
+    message: str
+    spec: str
+    input_size: int
+    input_mtime_ns: int
+
+
+def file_digest(path: str) -> str:
+    """
+    returns the sha256 hex digest of a file, read in 1 MB chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(spec: Any) -> str:
+    """
+    returns the sha256 hex digest of a json serializable spec
+    """
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def input_unchanged(entry: ManifestEntry, path: str) -> bool:
+    """
+    returns whether the input file still has the recorded size and mtime
+    """
+    stat = os.stat(path)
+    return (
+        stat.st_size == entry["input_size"]
+        and stat.st_mtime_ns == entry["input_mtime_ns"]
+    )
+
+
+def output_intact(entry: ManifestEntry, output_dir: str, pyramid_dir: str) -> bool:
+    """
+    returns whether the recorded outputs still exist with the recorded sizes,
+    so a deleted or truncated output is converted again
+    """
+    for path, size in [
+        (os.path.join(output_dir, entry["output"]), entry["output_size"]),
+        (os.path.join(pyramid_dir, entry["pyramid"]), entry["pyramid_size"]),
+    ]:
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            return False
+    return True
+
+
+def make_entry(
+    input_path: str,
+    input_sha256: str,
+    spec: str,
+    output_path: str,
+    pyramid_path: str,
+) -> ManifestEntry:
+    stat = os.stat(input_path)
+    return {
+        "input_size": stat.st_size,
+        "input_mtime_ns": stat.st_mtime_ns,
+        "input_sha256": input_sha256,
+        "spec": spec,
+        "output": os.path.basename(output_path),
+        "output_size": os.path.getsize(output_path),
+        "output_sha256": file_digest(output_path),
+        "pyramid": os.path.basename(pyramid_path),
+        "pyramid_size": os.path.getsize(pyramid_path),
+    }
+
+
+def make_rejected_entry(
+    input_path: str, reason: str, message: str, spec: str
+) -> RejectedEntry:
+    stat = os.stat(input_path)
+    return {
+        # log files are named <prefix>_<log id>.ulg
+        "log_id": os.path.basename(input_path)[-40:-4],
+        "reason": reason,
+        "message": message,
+        "spec": spec,
+        "input_size": stat.st_size,
+        "input_mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def still_rejected(entry: RejectedEntry | None, path: str, spec: str) -> bool:
+    """
+    returns whether the ulog file was rejected with the same spec and has not
+    changed since
+    """
+    return (
+        entry is not None and entry["spec"] == spec and input_unchanged(entry, path)
+    )
+
+
+def load_manifest(path: str) -> Dict[str, ManifestEntry]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(path: str, manifest: Dict[str, ManifestEntry]) -> None:
+    # write to a temporary file first so a killed run never leaves a
+    # truncated manifest behind
+    tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
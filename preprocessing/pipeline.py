@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+Downloads and converts logs at the same time.
+
+Logs are downloaded as in download_logs.py and every downloaded log goes
+through a bounded queue to the ulog2csv.py converters as soon as it is on
+disk. Downloads pause while the queue is full, so a slow conversion never
+lets raw logs pile up on disk. Logs already in the download folder are
+converted first.
+
+    python3 preprocessing/pipeline.py --jobs 4 --raw compress
+"""
+
+import os
+import gzip
+import shutil
+import argparse
+import threading
+import multiprocessing
+import download_logs
+import ulog2csv
+from queue import Queue
+from typing import Iterator
+
+
+def stream(queue: Queue) -> Iterator[str]:
+    """
+    yields the queued log paths until the downloader queues None
+    """
+    while True:
+        ulog_path = queue.get()
+        if ulog_path is None:
+            return
+        yield ulog_path
+
+
+def compress_raw(ulog_path: str) -> None:
+    """
+    replaces a raw ulog file by its gzip compressed copy
+    """
+    gz_path = ulog_path + ".gz"
+    tmp_path = os.path.join(os.path.dirname(gz_path), "." + os.path.basename(gz_path))
+    with open(ulog_path, "rb") as fin, gzip.open(tmp_path, "wb") as fout:
+        shutil.copyfileobj(fin, fout, 1 << 20)
+    os.replace(tmp_path, gz_path)
+    os.remove(ulog_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download logs and convert them as they arrive"
+    )
+    ulog2csv.add_arguments(parser)
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=8,
+        help="maximum number of downloaded logs waiting for conversion",
+    )
+    parser.add_argument(
+        "--raw",
+        choices=["keep", "delete", "compress"],
+        default="keep",
+        help="what to do with a raw ulog file once it has been converted",
+    )
+    args = parser.parse_args()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+
+    # change the working directory to be the script's directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    arguments = download_logs.read_arguments()
+    conn, _, source = download_logs.get_db_info(arguments)
+    existing_logs = download_logs.find_existing_logs()
+    db_entries_list = download_logs.filter_entries(conn, arguments, source)
+
+    # make sure output dirs exist
+    for dir in [ulog2csv.output_csv_dir, ulog2csv.pyramid_dir]:
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    queue = Queue(maxsize=args.queue_size)
+
+    def download():
+        try:
+            # logs downloaded by earlier runs go first
+            download_folder = download_logs.download_folder
+            for ulog_file_name in sorted(os.listdir(download_folder)):
+                if ulog_file_name.endswith(".ulg"):
+                    queue.put(os.path.join(download_folder, ulog_file_name))
+            download_logs.download_logs(
+                db_entries_list, arguments, existing_logs, on_log=queue.put
+            )
+        finally:
+            # let the converters finish even if the downloader gave up
+            queue.put(None)
+
+    def on_result(ulog_path: str, status: str) -> None:
+        if status not in [ulog2csv.CONVERTED, ulog2csv.EXISTS] or args.raw == "keep":
+            return
+        if args.raw == "delete":
+            os.remove(ulog_path)
+        else:
+            compress_raw(ulog_path)
+
+    downloader = threading.Thread(target=download, daemon=True)
+    downloader.start()
+    # the conversion of a raw log must be on disk before the log is removed.
+    # The downloader threads are running, forking this process could leave
+    # a worker with a lock held by one of them, workers are started from a
+    # fork server instead
+    summary = ulog2csv.convert_all(
+        stream(queue),
+        jobs,
+        args.format,
+        args.report_memory,
+        on_result,
+        save_before_result=args.raw != "keep",
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
+    downloader.join()
+    ulog2csv.print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
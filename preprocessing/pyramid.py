@@ -0,0 +1,93 @@
+"""
+Multi-resolution (level of detail) pyramids of the native rate log data.
+
+Level 0 of a column holds every sample at its native rate, every following
+level merges `factor` consecutive bins of the previous level and keeps the
+min and max of the merged bins, so spikes survive decimation. Levels stop
+once a column has fewer than `min_points` bins.
+
+All the levels of a log are stored in a single npz file,
+
+    __columns__  column names
+    c{i}.t       native timestamps of column i
+    c{i}.v       native values of column i
+    c{i}.t{k}    timestamp of the first sample of every bin of level k
+    c{i}.min{k}  min of every bin of level k
+    c{i}.max{k}  max of every bin of level k
+"""
+
+import numpy as np
+from typing import Dict, List, Tuple
+
+factor = 4
+min_points = 1000
+
+
+def build_levels(
+    timestamp: np.ndarray, values: np.ndarray
+) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    returns the (timestamp, min, max) arrays of every level above the native
+    rate, coarsest level last
+    """
+    levels = []
+    t, lo, hi = timestamp, values, values
+    while len(t) >= min_points * factor:
+        # reduceat also merges the shorter bin at the tail of the array
+        starts = np.arange(0, len(t), factor)
+        t = t[starts]
+        lo = np.minimum.reduceat(lo, starts)
+        hi = np.maximum.reduceat(hi, starts)
+        levels.append((t, lo, hi))
+    return levels
+
+
+def write_pyramid(
+    path: str, columns: List[str], series: List[Tuple[np.ndarray, np.ndarray]]
+) -> None:
+    """
+    writes the native rate (timestamp, values) series of every column along
+    with their decimation levels to `path`
+    """
+    arrays = {"__columns__": np.array(columns, dtype=str)}
+    for i, (timestamp, values) in enumerate(series):
+        arrays[f"c{i}.t"] = timestamp
+        arrays[f"c{i}.v"] = values
+        for k, (t, lo, hi) in enumerate(build_levels(timestamp, values), start=1):
+            arrays[f"c{i}.t{k}"] = t
+            arrays[f"c{i}.min{k}"] = lo
+            arrays[f"c{i}.max{k}"] = hi
+    np.savez_compressed(path, **arrays)
+
+
+def read_level(
+    data: Dict[str, np.ndarray],
+    column: str,
+    max_points: int,
+    start: int | None = None,
+    end: int | None = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    returns the (timestamp, min, max) arrays of the finest level of `column`
+    that has at most `max_points` bins between timestamps `start` and `end`,
+    `data` is the opened npz file. At the native rate min and max are the
+    same array.
+    """
+    i = data["__columns__"].tolist().index(column)
+    k = 0
+    while True:
+        t = data[f"c{i}.t{k}"] if k else data[f"c{i}.t"]
+        # include the bin that contains `start`
+        first = 0
+        if start is not None:
+            first = max(np.searchsorted(t, start, side="right") - 1, 0)
+        last = len(t) if end is None else np.searchsorted(t, end, side="right")
+        coarser = f"c{i}.t{k + 1}" in data
+        if last - first <= max_points or not coarser:
+            break
+        k += 1
+    window = slice(first, last)
+    if k == 0:
+        values = data[f"c{i}.v"][window]
+        return t[window], values, values
+    return t[window], data[f"c{i}.min{k}"][window], data[f"c{i}.max{k}"][window]
@@ -0,0 +1,65 @@
+import numpy as np
+
+
+def bin_mean(
+    values: np.ndarray, timestamp: np.ndarray, target: np.ndarray
+) -> np.ndarray:
+    # mean of all samples falling in (target[j - 1], target[j]], empty bins
+    # hold the first sample after the previous bin (or the last sample when
+    # the array has been exhausted)
+    final = np.zeros_like(target, dtype=np.float32)
+    if len(target) == 0:
+        return final
+
+    end = np.searchsorted(timestamp, target, side="right")
+    start = np.concatenate(([0], end[:-1]))
+    nonempty = end > start
+
+    if nonempty.any():
+        # bins of equal length are gathered into one 2d block and averaged
+        # row wise, so every bin goes through the same summation as a
+        # plain slice mean and the output stays bit-identical to it
+        bin_start = start[nonempty]
+        bin_len = end[nonempty] - bin_start
+        means = np.zeros(len(bin_start), dtype=np.float32)
+        for length in np.unique(bin_len):
+            sel = np.where(bin_len == length)[0]
+            block = values[bin_start[sel, None] + np.arange(length)]
+            means[sel] = block.mean(axis=1)
+        final[nonempty] = means
+
+    empty = ~nonempty
+    if empty.any():
+        final[empty] = values[np.minimum(start[empty], len(values) - 1)]
+    return final
+
+
+def sample_hold(
+    values: np.ndarray, timestamp: np.ndarray, target: np.ndarray
+) -> np.ndarray:
+    # first sample at or after every target timestamp (or the last sample
+    # when the target runs past the end of the array)
+    idx = np.searchsorted(timestamp, target, side="left")
+    final = np.zeros_like(target, dtype=np.float32)
+    if len(target) == 0:
+        return final
+    final[:] = values[np.minimum(idx, len(values) - 1)]
+    return final
+
+
+def compress(col1, col2):
+    # col1 should have more elements
+    if len(col1["timestamp"]) < len(col2["timestamp"]):
+        col1, col2 = col2, col1
+
+    col1["values"] = bin_mean(col1["values"], col1["timestamp"], col2["timestamp"])
+    col1["timestamp"] = col2["timestamp"]
+
+
+def expand(col1, col2):
+    # col1 should have more elements
+    if len(col1["timestamp"]) < len(col2["timestamp"]):
+        col1, col2 = col2, col1
+
+    col2["values"] = sample_hold(col2["values"], col2["timestamp"], col1["timestamp"])
+    col2["timestamp"] = col1["timestamp"]
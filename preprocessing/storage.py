@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+Storage formats for converted and annotated log files.
+
+Logs are stored one file per log, the format is picked from the file
+extension so csv, feather, parquet and npz files can live side by side in
+the same directory. Feather and parquet need pyarrow to be installed.
+
+Running this file migrates existing logs in data/csv_files and
+data/annotated_csv_files to another format,
+
+    python3 preprocessing/storage.py --to feather
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from typing import List
+
+from manifest import file_digest, load_manifest, save_manifest
+
+# file extension of every supported format
+FORMATS = {
+    "csv": ".csv",
+    "feather": ".feather",
+    "parquet": ".parquet",
+    "npz": ".npz",
+}
+
+DEFAULT_FORMAT = "feather"
+
+
+def log_name(path: str) -> str:
+    """
+    returns the log name (file name without the format extension)
+    """
+    name = os.path.basename(path)
+    for ext in FORMATS.values():
+        if name.endswith(ext):
+            return name[: -len(ext)]
+    return name
+
+
+def is_log_file(name: str) -> bool:
+    """
+    returns whether the file name has the extension of a supported format,
+    hidden files are partially written logs and are never listed
+    """
+    if name.startswith("."):
+        return False
+    return any(name.endswith(ext) for ext in FORMATS.values())
+
+
+def log_path(dir: str, name: str, fmt: str) -> str:
+    """
+    returns the path of log `name` stored in `dir` with format `fmt`
+    """
+    return os.path.join(dir, name + FORMATS[fmt])
+
+
+def format_of(path: str) -> str:
+    """
+    returns the format of a log file from its extension
+    """
+    for fmt, ext in FORMATS.items():
+        if path.endswith(ext):
+            return fmt
+    raise ValueError(f"Unknown log file format {path}")
+
+
+def find_log(dir: str, name: str) -> str | None:
+    """
+    returns the path of log `name` in `dir` whatever its format, or None
+    when no such log exists
+    """
+    for fmt in FORMATS:
+        path = log_path(dir, name, fmt)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def list_logs(dir: str) -> List[str]:
+    """
+    returns the paths of all the log files in `dir`
+    """
+    return [os.path.join(dir, name) for name in os.listdir(dir) if is_log_file(name)]
+
+
+def write_df(df: pd.DataFrame, path: str) -> None:
+    fmt = format_of(path)
+    if fmt == "csv":
+        df.to_csv(path, index=False)
+    elif fmt == "feather":
+        # uncompressed, so the server can memory map the columns instead of
+        # decompressing every buffer (parquet is the compact format)
+        df.to_feather(path, compression="uncompressed")
+    elif fmt == "parquet":
+        df.to_parquet(path, index=False, compression="zstd")
+    elif fmt == "npz":
+        # column names may contain characters npz keys can't hold, so they
+        # are stored separately in column order
+        np.savez_compressed(
+            path,
+            __columns__=np.array(df.columns, dtype=str),
+            **{f"c{i}": df[col].to_numpy() for i, col in enumerate(df.columns)},
+        )
+
+
+def write_df_atomic(df: pd.DataFrame, path: str) -> None:
+    """
+    writes the log to a hidden temporary file and renames it into place, so
+    an interrupted write never leaves a truncated log behind
+    """
+    tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+    try:
+        write_df(df, tmp_path)
+        # make sure the data is on disk before the log shows up under its name
+        with open(tmp_path, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_df(path: str) -> pd.DataFrame:
+    fmt = format_of(path)
+    if fmt == "csv":
+        return pd.read_csv(path)
+    if fmt == "feather":
+        from pyarrow import feather
+
+        # memory map the file so uncompressed buffers are read zero copy,
+        # logs written lz4 compressed by earlier versions are decompressed
+        table = feather.read_table(path, memory_map=True)
+        return table.to_pandas(split_blocks=True)
+    if fmt == "parquet":
+        return pd.read_parquet(path, memory_map=True)
+    with np.load(path) as data:
+        columns = data["__columns__"].tolist()
+        return pd.DataFrame(
+            {col: data[f"c{i}"] for i, col in enumerate(columns)}, copy=False
+        )
+
+
+def migrate(dir: str, fmt: str, keep: bool = False) -> int:
+    """
+    converts every log in `dir` to format `fmt`, the original files are
+    removed unless `keep` is set, returns the number of migrated logs. The
+    manifest of the converted logs in `dir` is updated to the migrated
+    files, so they are not converted again
+    """
+    manifest_path = os.path.join(dir, "manifest.json")
+    manifest = load_manifest(manifest_path)
+    entries = {entry["output"]: entry for entry in manifest.values()}
+    n_migrated = 0
+    try:
+        for path in sorted(list_logs(dir)):
+            if format_of(path) == fmt:
+                continue
+            new_path = log_path(dir, log_name(path), fmt)
+            if not os.path.exists(new_path):
+                write_df_atomic(read_df(path), new_path)
+                print(f"Migrated {path} to {new_path}")
+                n_migrated += 1
+            entry = entries.get(os.path.basename(path))
+            if entry is not None:
+                entry["output"] = os.path.basename(new_path)
+                entry["output_size"] = os.path.getsize(new_path)
+                entry["output_sha256"] = file_digest(new_path)
+            if not keep:
+                os.remove(path)
+    finally:
+        if manifest:
+            save_manifest(manifest_path, manifest)
+    return n_migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate log files to a format")
+    parser.add_argument(
+        "--to",
+        choices=FORMATS.keys(),
+        default=DEFAULT_FORMAT,
+        help="format to migrate the logs to",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the original log files"
+    )
+    parser.add_argument(
+        "dirs",
+        nargs="*",
+        help="directories to migrate, defaults to the converted and annotated logs",
+    )
+    args = parser.parse_args()
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    dirs = args.dirs or [
+        os.path.join(cwd, "../data/csv_files"),
+        os.path.join(cwd, "../data/annotated_csv_files"),
+    ]
+    for dir in dirs:
+        if not os.path.isdir(dir):
+            continue
+        n_migrated = migrate(dir, args.to, args.keep)
+        print(f"{n_migrated} logs in {dir} migrated to {args.to}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,37 @@
 #!/usr/bin/env python3
 
 import os
+import inspect
+import tracemalloc
+import argparse
 import numpy as np
 import pandas as pd
 from pyulog import ULog
 from pyulog.px4 import PX4ULog
-from typing import TypedDict, List
+import catalog
+import pyramid
+import resample
+from pyramid import write_pyramid
+from resample import compress, expand
+from storage import FORMATS, DEFAULT_FORMAT, log_path, read_df, write_df_atomic
+from manifest import (
+    ManifestEntry,
+    file_digest,
+    fingerprint,
+    input_unchanged,
+    load_manifest,
+    make_entry,
+    make_rejected_entry,
+    output_intact,
+    save_manifest,
+    still_rejected,
+)
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing.context import BaseContext
+from typing import TypedDict, Callable, Dict, Iterable, List, Optional, Tuple
 
 
 class MissionData(TypedDict):
@@ -36,7 +62,14 @@ params = {
 def extract_mission_mode(ulog) -> List[MissionData] | str:
     # find largest mission subarray
     # 3 is mission mode
-    arr = ulog.get_dataset("vehicle_status").data["nav_state"] == 3
+    try:
+        status = ulog.get_dataset("vehicle_status").data
+    except (KeyError, IndexError, ValueError) as error:
+        return "vehicle_status"
+    arr = status["nav_state"] == 3
+    if not arr.any():
+        # the log never entered mission mode
+        return []
     diff = np.diff(arr.astype(int))
     start = (np.where(diff == 1)[0] + 1).tolist()
     end = (np.where(diff == -1)[0] + 1).tolist()
@@ -45,8 +78,8 @@ def extract_mission_mode(ulog) -> List[MissionData] | str:
     if arr[-1] == 1:
         end = end + [len(arr)]  # ends with True
     arg = np.subtract(end, start).argmax()
-    start_time = ulog.get_dataset("vehicle_status").data["timestamp"][start[arg]]
-    end_time = ulog.get_dataset("vehicle_status").data["timestamp"][end[arg] - 1]
+    start_time = status["timestamp"][start[arg]]
+    end_time = status["timestamp"][end[arg] - 1]
 
     cols = []
     for dataset, attrs in params.items():
@@ -54,62 +87,38 @@ def extract_mission_mode(ulog) -> List[MissionData] | str:
             data = ulog.get_dataset(dataset).data
         except (KeyError, IndexError, ValueError) as error:
             return dataset
+        # timestamps are sorted, so the samples strictly inside the mission
+        # window form one contiguous slice shared by every attribute of the
+        # dataset and the columns are views into the log data
+        timestamp = data["timestamp"]
+        window = slice(
+            np.searchsorted(timestamp, start_time, side="right"),
+            np.searchsorted(timestamp, end_time, side="left"),
+        )
         for attr in attrs:
             values = data.get(attr)
-            timestamp = data["timestamp"]
-            mission_idx = np.where((timestamp > start_time) & (timestamp < end_time))[0]
-
             if values is None:
                 raise KeyError(f"{attr} not found in {dataset}")
             cols.append(
                 {
                     "dataset": dataset,
                     "attr": attr,
-                    "timestamp": timestamp[mission_idx],
-                    "values": values[mission_idx],
+                    "timestamp": timestamp[window],
+                    "values": values[window],
                 }
             )
 
     return cols
 
 
-def compress(col1, col2):
-    # col1 should have more elements
-    if len(col1["timestamp"]) < len(col2["timestamp"]):
-        col1, col2 = col2, col1
-
-    idx = np.searchsorted(col1["timestamp"], col2["timestamp"], side="right")
-
-    start = 0
-    final = np.zeros_like(col2["timestamp"], dtype=np.float32)
-    for j, i in enumerate(idx):
-        if i > start:
-            final[j] = col1["values"][start:i].mean()
-        else:
-            final[j] = col1["values"][start if start < len(col1["values"]) else -1]
-        start = i
-    col1["timestamp"] = col2["timestamp"]
-    col1["values"] = final
-
-
-def expand(col1, col2):
-    # col1 should have more elements
-    if len(col1["timestamp"]) < len(col2["timestamp"]):
-        col1, col2 = col2, col1
-
-    idx = np.searchsorted(col2["timestamp"], col1["timestamp"], side="left")
-
-    final = np.zeros_like(col1["timestamp"], dtype=np.float32)
-    for j, i in enumerate(idx):
-        final[j] = col2["values"][i if i < len(col2["values"]) else -1]
-    col2["timestamp"] = col1["timestamp"]
-    col2["values"] = final
+# vehicle_local_position.x is 10 Hz, all log attributes are aligned to it
+reference = 6
 
 
 def align_cols(cols: List[MissionData]) -> None:
     # vehicle_local_position.x is 10 Hz, so this should make
     # all log attributes 10 Hz
-    idx = 6  # vehicle_local_position.x
+    idx = reference
     for col in cols:
         if len(col["timestamp"]) > len(cols[idx]["timestamp"]):
             compress(col, cols[idx])
@@ -118,53 +127,351 @@ def align_cols(cols: List[MissionData]) -> None:
 
 
 def cols_to_df(cols: List[MissionData]) -> pd.DataFrame:
-    return pd.DataFrame(
-        np.vstack([cols[0]["timestamp"]] + [col["values"] for col in cols]).T,
-        columns=["timestamp"] + [f'{col["dataset"]}.{col["attr"]}' for col in cols],
-    )
-
+    # every column keeps its own dtype (int64 microsecond timestamps, float32
+    # values) and is handed to pandas as is, without stacking the columns
+    # into one float64 matrix first
+    data = {"timestamp": cols[0]["timestamp"].astype(np.int64, copy=False)}
+    for col in cols:
+        data[f'{col["dataset"]}.{col["attr"]}'] = col["values"].astype(
+            np.float32, copy=False
+        )
+    return pd.DataFrame(data, copy=False)
 
-# change to current file's dir
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 cwd = os.path.dirname(os.path.abspath(__file__))
 ulg_dir = os.path.join(cwd, "../data/ulg_files")
-ulg_paths = [
-    os.path.join(ulg_dir, ulg_file_name) for ulg_file_name in os.listdir(ulg_dir)
-]
+output_csv_dir = os.path.join(cwd, "../data/csv_files")
+pyramid_dir = os.path.join(cwd, "../data/pyramid_files")
+manifest_file = os.path.join(output_csv_dir, "manifest.json")
+rejected_file = os.path.join(output_csv_dir, "rejected.json")
+catalog_file = os.path.join(output_csv_dir, "catalog.sqlite")
 
 filter = [k for k in params.keys()] + ["vehicle_status"]
 
-output_csv_dir = os.path.join(cwd, "../data/csv_files")
+# possible outcomes of converting a single ulog file
+CONVERTED = "converted"
+EXISTS = "exists"
+SHORT = "skipped-short"
+MISSING = "skipped-missing-dataset"
+FAILED = "failed"
+REJECTED = "skipped-rejected"
+
+
+def spec_fingerprint() -> str:
+    """
+    returns the fingerprint of everything that decides the converted output,
+    outputs converted with another fingerprint are stale
+    """
+    return fingerprint(
+        {
+            "params": params,
+            "reference": reference,
+            "code": [
+                inspect.getsource(obj)
+                for obj in [
+                    extract_mission_mode,
+                    align_cols,
+                    cols_to_df,
+                    resample,
+                    pyramid,
+                ]
+            ],
+        }
+    )
+
+
+spec = spec_fingerprint()
+
+# (pid, connection) of the catalog, every worker process opens its own
+_catalog = None
+
+
+def catalog_conn():
+    global _catalog
+    if _catalog is None or _catalog[0] != os.getpid():
+        _catalog = (os.getpid(), catalog.connect(catalog_file))
+    return _catalog[1]
+
+
+def convert_file(
+    ulog_path: str,
+    entry: Optional[ManifestEntry] = None,
+    fmt: str = DEFAULT_FORMAT,
+    report_memory: bool = False,
+) -> Tuple[str, str, Optional[ManifestEntry]]:
+    """
+    converts a single ulog file to format `fmt` unless its manifest `entry`
+    shows the output is up to date, returns its status along with a message
+    to report and the new manifest entry, errors are caught so that a bad
+    file never takes down the rest of the batch. With `report_memory` the
+    peak memory allocated while converting is added to the message
+    """
+    if not report_memory:
+        return _convert_file(ulog_path, entry, fmt)
+
+    tracemalloc.start()
+    try:
+        status, msg, entry = _convert_file(ulog_path, entry, fmt)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return status, f"{msg} (peak memory {peak / 2**20:.1f} MB)", entry
+
+
+def _convert_file(
+    ulog_path: str, entry: Optional[ManifestEntry], fmt: str
+) -> Tuple[str, str, Optional[ManifestEntry]]:
+    name = os.path.basename(ulog_path)[:-4]
+    csv_loc = log_path(output_csv_dir, name, fmt)
+    pyramid_loc = os.path.join(pyramid_dir, name + ".npz")
+
+    try:
+        # annotations are rows of the converted log, the converted log of an
+        # annotated log is never converted again nor removed
+        if catalog.is_annotated(catalog_conn(), name):
+            return EXISTS, f"File {name} is annotated, keeping it as is...", entry
+        input_sha256 = None
+        if (
+            entry is not None
+            and entry["spec"] == spec
+            and entry["output"] == os.path.basename(csv_loc)
+            and output_intact(entry, output_csv_dir, pyramid_dir)
+        ):
+            msg = f"File {csv_loc} already processed, skipping..."
+            # logs converted before the catalog existed are recorded once
+            if not catalog.has_log(catalog_conn(), csv_loc):
+                catalog.record_log(catalog_conn(), csv_loc, read_df(csv_loc))
+            if input_unchanged(entry, ulog_path):
+                return EXISTS, msg, entry
+            # only hash the input once its size or mtime changed
+            input_sha256 = file_digest(ulog_path)
+            if input_sha256 == entry["input_sha256"]:
+                stat = os.stat(ulog_path)
+                entry = dict(
+                    entry, input_size=stat.st_size, input_mtime_ns=stat.st_mtime_ns
+                )
+                return EXISTS, msg, entry
+        if input_sha256 is None:
+            input_sha256 = file_digest(ulog_path)
+
+        ulog = ULog(ulog_path, filter)
+        px4ulog = PX4ULog(ulog)
+        px4ulog.add_roll_pitch_yaw()
+
+        cols = extract_mission_mode(ulog)
+        if isinstance(cols, str):
+            return MISSING, f"Skipping {ulog_path}, missing dataset {cols}", None
+        if len(cols) == 0:
+            return SHORT, f"No mission mode in file {csv_loc}, skipping...", None
+        if min(map(lambda x: len(x["timestamp"]), cols)) < 20:
+            msg = f"Mission mode in file {csv_loc} too short, skipping..."
+            return SHORT, msg, None
+        # align_cols replaces the series in cols, keep the native rate ones
+        # for the pyramid
+        columns = [f'{col["dataset"]}.{col["attr"]}' for col in cols]
+        native = [(col["timestamp"], col["values"]) for col in cols]
+        align_cols(cols)
+        df = cols_to_df(cols)
+
+        # save to disk
+        if df.shape[0] < 100:
+            msg = f"Mission mode in file {csv_loc} too short, skipping..."
+            return SHORT, msg, None
+        write_df_atomic(df, csv_loc)
+
+        # write to a hidden file first like the converted log
+        tmp_loc = os.path.join(pyramid_dir, "." + os.path.basename(pyramid_loc))
+        write_pyramid(tmp_loc, columns, native)
+        os.replace(tmp_loc, pyramid_loc)
+
+        # remove the output of a previous conversion to another format
+        if entry is not None and entry["output"] != os.path.basename(csv_loc):
+            old_loc = os.path.join(output_csv_dir, entry["output"])
+            if os.path.exists(old_loc):
+                os.remove(old_loc)
+        entry = make_entry(ulog_path, input_sha256, spec, csv_loc, pyramid_loc)
+        catalog.record_log(catalog_conn(), csv_loc, df)
+    except Exception as error:
+        return FAILED, f"Failed to convert {ulog_path}: {error!r}", None
+    return CONVERTED, f"Converted {ulog_path} to {fmt}", entry
+
+
+def convert_all(
+    ulg_paths: Iterable[str],
+    jobs: int = 1,
+    fmt: str = DEFAULT_FORMAT,
+    report_memory: bool = False,
+    on_result: Optional[Callable[[str, str], None]] = None,
+    save_before_result: bool = False,
+    mp_context: Optional[BaseContext] = None,
+) -> Dict[str, int]:
+    """
+    converts every ulog file in ulg_paths to format `fmt` using `jobs` worker
+    processes, progress is reported in the same order as ulg_paths and
+    `on_result` is called with the path and status of every file. ulg_paths
+    may be a stream of files that arrive while converting, at most 2 * jobs
+    files are in flight so the stream is only consumed as fast as the files
+    are converted. With `save_before_result` a new or updated manifest entry
+    is saved before `on_result` is called, so `on_result` may remove the
+    ulog file. The workers are started with `mp_context`, the default fork
+    is not safe when the calling process runs other threads
+    """
+    convert = partial(convert_file, fmt=fmt, report_memory=report_memory)
+    summary = {
+        status: 0
+        for status in [CONVERTED, EXISTS, SHORT, MISSING, REJECTED, FAILED]
+    }
+
+    # entries are keyed by ulog file name, logs that failed have no entry and
+    # are always converted again, logs that were rejected are only converted
+    # again once the spec or the ulog file changes
+    manifest = load_manifest(manifest_file)
+    rejected = load_manifest(rejected_file)
+
+    def report(ulog_path: str, result: Future) -> None:
+        name = os.path.basename(ulog_path)
+        try:
+            status, msg, entry = result.result()
+        except BrokenProcessPool as error:
+            # a worker was killed (e.g. out of memory) or crashed, the files
+            # it took down with it fail and are converted again next run
+            msg = f"Failed to convert {ulog_path}: {error!r}"
+            status, entry = FAILED, None
+        summary[status] += 1
+        n_done = sum(summary.values())
+        print(f"{n_done} | {msg}")
+        if status in [SHORT, MISSING]:
+            rejected[name] = make_rejected_entry(ulog_path, status, msg, spec)
+        elif status != REJECTED:
+            rejected.pop(name, None)
+        saved = True
+        if entry is not None:
+            saved = manifest.get(name) == entry
+            manifest[name] = entry
+        elif name in manifest:
+            # a rejected log must not leave a stale output behind
+            old_entry = manifest.pop(name)
+            old_locs = [os.path.join(output_csv_dir, old_entry["output"])]
+            if "pyramid" in old_entry:
+                old_locs.append(os.path.join(pyramid_dir, old_entry["pyramid"]))
+            for old_loc in old_locs:
+                if status != FAILED and os.path.exists(old_loc):
+                    os.remove(old_loc)
+            if status != FAILED:
+                catalog.remove_log(catalog_conn(), name[:-4])
+        # save now and then so a killed run keeps most of its work
+        if n_done % 50 == 0 or (save_before_result and not saved):
+            save_manifest(manifest_file, manifest)
+            save_manifest(rejected_file, rejected)
+        if on_result is not None:
+            on_result(ulog_path, status)
+
+    pending = deque()
+    executor = ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context)
+    try:
+        for ulog_path in ulg_paths:
+            name = os.path.basename(ulog_path)
+            if still_rejected(rejected.get(name), ulog_path, spec):
+                reason = rejected[name]["reason"]
+                msg = f"Skipping {ulog_path}, rejected before ({reason})"
+                result = Future()
+                result.set_result((REJECTED, msg, None))
+            elif jobs > 1:
+                try:
+                    result = executor.submit(convert, ulog_path, manifest.get(name))
+                except BrokenProcessPool:
+                    # a worker died, the rest of the batch goes to a new pool
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(
+                        max_workers=jobs, mp_context=mp_context
+                    )
+                    result = executor.submit(convert, ulog_path, manifest.get(name))
+            else:
+                # workers are only spawned on the first submit, so a single
+                # job converts in this process without the pool
+                result = Future()
+                result.set_result(convert(ulog_path, manifest.get(name)))
+            pending.append((ulog_path, result))
+
+            # report finished files in order, and wait for the oldest one
+            # once too many files are in flight
+            while pending and (pending[0][1].done() or len(pending) > 2 * jobs):
+                report(*pending.popleft())
+        while pending:
+            report(*pending.popleft())
+    finally:
+        executor.shutdown()
+        save_manifest(manifest_file, manifest)
+        save_manifest(rejected_file, rejected)
+    return summary
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    adds the conversion options to `parser`, they are shared with the
+    download-to-convert pipeline
+    """
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes, 0 uses all available cores",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=FORMATS.keys(),
+        default=DEFAULT_FORMAT,
+        help="format of the converted logs, csv is kept as an export option",
+    )
+    parser.add_argument(
+        "--report-memory",
+        action="store_true",
+        help="report the peak memory allocated while converting each file",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert ulog files to csv or a columnar format"
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+
+    # change to current file's dir
+    os.chdir(cwd)
+
+    # raw logs compressed by the pipeline have already been converted
+    ulg_paths = [
+        os.path.join(ulg_dir, ulg_file_name)
+        for ulg_file_name in os.listdir(ulg_dir)
+        if ulg_file_name.endswith(".ulg")
+    ]
+
+    # make sure output dirs exist
+    for dir in [output_csv_dir, pyramid_dir]:
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+
+    summary = convert_all(ulg_paths, jobs, args.format, args.report_memory)
+    print_summary(summary)
+
+
+def print_summary(summary: Dict[str, int]) -> None:
+    print(
+        "{:} converted, {:} already processed, {:} too short, "
+        "{:} missing dataset, {:} rejected before, {:} failed".format(
+            summary[CONVERTED],
+            summary[EXISTS],
+            summary[SHORT],
+            summary[MISSING],
+            summary[REJECTED],
+            summary[FAILED],
+        )
+    )
+
 
-# make sure output csv dir exist
-if not os.path.isdir(output_csv_dir):
-    os.makedirs(output_csv_dir)
-
-for i, ulog_path in enumerate(ulg_paths):
-    csv_loc = os.path.join(output_csv_dir, os.path.basename(ulog_path)[:-4] + ".csv")
-
-    if os.path.exists(csv_loc):
-        print(f"{i+1} | File {csv_loc} already processed, skipping...")
-        continue
-
-    ulog = ULog(ulog_path, filter)
-    px4ulog = PX4ULog(ulog)
-    px4ulog.add_roll_pitch_yaw()
-
-    cols = extract_mission_mode(ulog)
-    if isinstance(cols, str):
-        print(f"{i+1} | Skipping {ulog_path}, missing dataset {cols}")
-        continue
-    if min(map(lambda x: len(x["timestamp"]), cols)) < 20:
-        print(f"{i+1} | Mission mode in file {csv_loc} too short, skipping...")
-        continue
-    align_cols(cols)
-    df = cols_to_df(cols)
-
-    # save to csv
-    if df.shape[0] < 100:
-        print(f"{i+1} | Mission mode in file {csv_loc} too short, skipping...")
-        continue
-    print(f"{i+1} | Converting {ulog_path} to csv")
-    df.to_csv(csv_loc, index=False)
+if __name__ == "__main__":
+    main()
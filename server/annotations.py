@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+"""
+Sparse store of the annotated anomalies.
+
+Annotations are stored as intervals of rows (log id, figure, first row,
+last row, annotator, time) in a SQLite database instead of full copies of
+the annotated logs with a boolean column per figure. Dense boolean columns
+are only generated when exporting.
+
+Running this file imports annotated logs written by earlier versions into
+the store, or exports every annotated log with its boolean columns,
+
+    python3 server/annotations.py import
+    python3 server/annotations.py export --format csv
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from typing import Any, Dict, Iterable, List, Tuple
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(cwd, "../preprocessing"))
+from storage import FORMATS, find_log, list_logs, log_name, log_path, read_df
+from storage import write_df_atomic
+from plotting import add_annotation, intervals_from_df
+
+schema = """
+CREATE TABLE IF NOT EXISTS annotated_logs (
+    log_id TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    annotator TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS intervals (
+    log_id TEXT NOT NULL,
+    figure TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS legacy_logs (
+    log_id TEXT PRIMARY KEY,
+    annotator TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS intervals_log_id ON intervals(log_id);
+CREATE INDEX IF NOT EXISTS annotated_logs_created ON annotated_logs(created);
+CREATE INDEX IF NOT EXISTS annotated_logs_annotator
+    ON annotated_logs(annotator COLLATE NOCASE, created);
+"""
+
+# orders the annotated logs can be listed in
+sorts = {
+    "newest": "created DESC",
+    "oldest": "created",
+    "log_id": "log_id",
+    "annotator": "annotator COLLATE NOCASE, created",
+}
+
+
+def clamp_ranges(data: Any, num_rows: int) -> List[Tuple[str, int, int]]:
+    """
+    returns the (figure, first row, last row) intervals of the box data sent
+    by the browser, clamped to the rows of the log like add_annotation does.
+    Boxes outside of the log are dropped, add_annotation marks no row for
+    them
+    """
+    intervals = [
+        (name, max(0, xmin), min(xmax, num_rows - 1))
+        for name, ranges in data
+        for xmin, xmax in ranges
+    ]
+    return [(name, start, end) for name, start, end in intervals if start <= end]
+
+
+def search_clause(search: str) -> Tuple[str, List[str]]:
+    """
+    returns the condition matching the rows whose log id or annotator
+    contains `search`, and its parameters
+    """
+    # wildcards typed in the search match themselves
+    for char in "\\%_":
+        search = search.replace(char, "\\" + char)
+    pattern = f"%{search}%"
+    condition = "(log_id LIKE ? ESCAPE '\\' OR annotator LIKE ? ESCAPE '\\')"
+    return condition, [pattern, pattern]
+
+
+class AnnotationStore:
+    """
+    SQLite store of annotated logs and their intervals, every thread (and
+    every forked server process) gets its own connection
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.local = threading.local()
+        with self.conn() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(schema)
+
+    def conn(self) -> sqlite3.Connection:
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.conn = sqlite3.connect(self.db_path, timeout=30)
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def save(
+        self,
+        log_id: str,
+        file: str,
+        annotator: str,
+        intervals: List[Tuple[str, int, int]],
+        created: float | None = None,
+    ) -> None:
+        """
+        stores the intervals of an annotated log, replacing any earlier ones
+        """
+        with self.conn() as conn:
+            conn.execute("DELETE FROM intervals WHERE log_id = ?", (log_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO annotated_logs VALUES (?, ?, ?, ?)",
+                (log_id, file, annotator, created or time.time()),
+            )
+            conn.executemany(
+                "INSERT INTO intervals VALUES (?, ?, ?, ?)",
+                ((log_id, *interval) for interval in intervals),
+            )
+
+    def has(self, log_id: str) -> bool:
+        row = self.conn().execute(
+            "SELECT 1 FROM annotated_logs WHERE log_id = ?", (log_id,)
+        ).fetchone()
+        return row is not None
+
+    def annotated_logs(self) -> List[Tuple[str, str, str]]:
+        """
+        returns the (log id, file, annotator) of every annotated log
+        """
+        return self.conn().execute(
+            "SELECT log_id, file, annotator FROM annotated_logs ORDER BY created"
+        ).fetchall()
+
+    def query(
+        self, search: str = "", sort: str = "newest", limit: int = 50, offset: int = 0
+    ) -> Tuple[List[Tuple[str, str, float]], int]:
+        """
+        returns a page of the (log id, annotator, time) of the annotated logs
+        whose log id or annotator contains `search`, along with the number of
+        matching logs
+        """
+        where, params = "", []
+        if search:
+            where, params = search_clause(search)
+            where = "WHERE " + where
+        conn = self.conn()
+        total = conn.execute(
+            f"SELECT count(*) FROM annotated_logs {where}", params
+        ).fetchone()[0]
+        rows = conn.execute(
+            f"""
+            SELECT log_id, annotator, created FROM annotated_logs {where}
+            ORDER BY {sorts[sort]} LIMIT ? OFFSET ?
+            """,
+            params + [limit, offset],
+        ).fetchall()
+        return rows, total
+
+    def legacy_recorded(self) -> bool:
+        row = self.conn().execute(
+            "SELECT 1 FROM meta WHERE key = 'legacy_recorded'"
+        ).fetchone()
+        return row is not None
+
+    def record_legacy(self, logs: Iterable[Tuple[str, str]]) -> None:
+        """
+        records the (log id, annotator) of the annotated copies written by
+        earlier versions, so they are listed without listing their directory
+        """
+        with self.conn() as conn:
+            conn.executemany("INSERT OR IGNORE INTO legacy_logs VALUES (?, ?)", logs)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_recorded', '1')")
+
+    def legacy_logs(
+        self, search: str = "", limit: int = -1, offset: int = 0
+    ) -> Tuple[List[Tuple[str, str]], int]:
+        """
+        returns a page of the (log id, annotator) of the annotated copies
+        written by earlier versions that were not imported into the store,
+        whose log id or annotator contains `search`, along with the number
+        of matching copies
+        """
+        where, params = "log_id NOT IN (SELECT log_id FROM annotated_logs)", []
+        if search:
+            clause, params = search_clause(search)
+            where += " AND " + clause
+        conn = self.conn()
+        total = conn.execute(
+            f"SELECT count(*) FROM legacy_logs WHERE {where}", params
+        ).fetchone()[0]
+        rows = conn.execute(
+            f"""
+            SELECT log_id, annotator FROM legacy_logs WHERE {where}
+            ORDER BY log_id LIMIT ? OFFSET ?
+            """,
+            params + [limit, offset],
+        ).fetchall()
+        return rows, total
+
+    def intervals(self, log_id: str) -> Dict[str, List[Tuple[int, int]]]:
+        """
+        returns the (first row, last row) intervals of a log by figure
+        """
+        intervals = {}
+        for figure, start, end in self.conn().execute(
+            "SELECT figure, start, end FROM intervals WHERE log_id = ?", (log_id,)
+        ):
+            intervals.setdefault(figure, []).append((start, end))
+        return intervals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import or export annotations")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument(
+        "--format",
+        choices=FORMATS.keys(),
+        default="csv",
+        help="format of the exported annotated logs",
+    )
+    args = parser.parse_args()
+
+    csv_dir = os.path.join(cwd, "../data/csv_files")
+    output_csv_dir = os.path.join(cwd, "../data/annotated_csv_files")
+    store = AnnotationStore(os.path.join(output_csv_dir, "annotations.sqlite"))
+
+    if args.command == "import":
+        # annotated logs written by earlier versions, with their contributors
+        # from mapping.json
+        mapping = {}
+        mapping_file = os.path.join(output_csv_dir, "mapping.json")
+        if os.path.exists(mapping_file):
+            with open(mapping_file, "r") as f:
+                mapping = json.load(f)
+        n_imported = 0
+        for path in list_logs(output_csv_dir):
+            name = log_name(path)
+            if store.has(name):
+                continue
+            intervals = [
+                (figure, start, end)
+                for figure, ranges in intervals_from_df(read_df(path)).items()
+                for start, end in ranges
+            ]
+            annotator = mapping.get(name, "Anonymous")
+            store.save(name, os.path.basename(path), annotator, intervals)
+            n_imported += 1
+        print(f"Imported {n_imported} annotated logs")
+        return
+
+    n_exported = 0
+    for name, _, _ in store.annotated_logs():
+        csv_path = find_log(csv_dir, name)
+        if csv_path is None:
+            print(f"Skipping {name}, log not found in {csv_dir}")
+            continue
+        df = read_df(csv_path)
+        data = [
+            [figure, [list(interval) for interval in ranges]]
+            for figure, ranges in store.intervals(name).items()
+        ]
+        add_annotation(df, data)
+        write_df_atomic(df, log_path(output_csv_dir, name, args.format))
+        n_exported += 1
+    print(f"Exported {n_exported} annotated logs to {output_csv_dir}")
+
+
+if __name__ == "__main__":
+    main()
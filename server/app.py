@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
 
+from tornado.template import Template
 from tornado.web import RequestHandler
 
 from bokeh.layouts import row, column
 from bokeh.plotting import Document
 from bokeh.server.server import Server
-from plotting import add_annotation, annotate_plot, plot_df
+from plotting import annotate_plot, intervals_from_df, open_pyramid, plot_df
+from annotations import AnnotationStore, clamp_ranges, sorts
+from prefetch import PrefetchPool
+from cache import FrameCache
+from metrics import Metrics
+from saves import WriteBehind, compact_journal
+from work_queue import WorkQueue
 from bokeh.models import (
     CustomJS,
     ColumnDataSource,
@@ -13,19 +20,72 @@ from bokeh.models import (
     Div,
     TextInput,
     InlineStyleSheet,
-    Paragraph,
 )
 
 import os
+import sys
+import signal
 import json
-import numpy as np
+import time
+import argparse
 import pandas as pd
+from functools import partial
+from urllib.parse import urlencode
 from typing import Optional, Tuple
 
 cwd = os.path.dirname(os.path.abspath(__file__))
+
+# storage formats are shared with the preprocessing scripts
+sys.path.append(os.path.join(cwd, "../preprocessing"))
+from storage import find_log, list_logs, log_name, read_df
+import catalog
+
 csv_dir = os.path.join(cwd, "../data/csv_files")
 output_csv_dir = os.path.join(cwd, "../data/annotated_csv_files")
 mapping_file = os.path.join(cwd, "../data/annotated_csv_files/mapping.json")
+journal_file = os.path.join(cwd, "../data/annotated_csv_files/mapping.jsonl")
+annotations_db = os.path.join(cwd, "../data/annotated_csv_files/annotations.sqlite")
+catalog_file = os.path.join(cwd, "../data/csv_files/catalog.sqlite")
+
+# logs are leased for lease_s and the leases of the logs in use are renewed
+# every renew_interval_s, the log of a crashed process or of a session that
+# went away unnoticed goes back to the queue once its lease expires
+lease_s = 600
+renew_interval_s = 60
+# prefetched logs are only leased for prefetch_lease_s and never renewed,
+# logs prefetched by an idle process go back to the queue for the others
+prefetch_lease_s = 60
+
+# deflate websocket messages, the plot data of a log is sent on every
+# transition
+websocket_compression_level = 6
+
+# metrics of this server process, served at /metrics
+metrics = Metrics("annotate")
+log_load_time = metrics.histogram("log_load_seconds", "Time to parse a log file")
+plot_time = metrics.histogram("plot_df_seconds", "Time to draw a log in the figures")
+annotation_time = metrics.histogram(
+    "annotation_seconds",
+    "Time to turn the boxes of a save into intervals, or intervals into boxes",
+)
+save_journal_time = metrics.histogram(
+    "save_journal_seconds", "Time to journal a save on the IO loop"
+)
+save_store_time = metrics.histogram(
+    "save_store_seconds", "Time to store the intervals of a save in the background"
+)
+session_time = metrics.histogram(
+    "session_setup_seconds", "Time to set up an annotation or viewer session"
+)
+
+parser = argparse.ArgumentParser(description="Annotate anomalies in PX4 logs")
+parser.add_argument(
+    "--num-procs",
+    type=int,
+    default=1,
+    help="number of server processes, 0 for one per cpu",
+)
+arguments = parser.parse_args()
 
 # make sure files and dirs exist
 if not os.path.isdir(csv_dir):
@@ -33,34 +93,235 @@ if not os.path.isdir(csv_dir):
 if not os.path.isdir(output_csv_dir):
     os.makedirs(output_csv_dir)
 
+# contributors of the annotated copies written by earlier versions
 mapping = {}
 if os.path.exists(mapping_file):
     with open(mapping_file, "r") as f:
         mapping = json.load(f)
 
-# only include files which haven't been annotated
-csv_paths = [
-    os.path.join(csv_dir, csv_file_name)
-    for csv_file_name in set(os.listdir(csv_dir)).difference(os.listdir(output_csv_dir))
-]
+# the work queue is the catalog of converted logs, shared by every server
+# process of this host
+work_queue = WorkQueue(catalog_file, csv_dir, lease_s)
+
+# annotations are stored as intervals in the background after their save
+# has been journaled, store the ones a crash left out. The journal is
+# emptied once stored, so startup only goes through the saves made since
+# the last one
+store = AnnotationStore(annotations_db)
+
+
+def replay(entry: dict) -> None:
+    if store.has(entry["name"]):
+        return
+    store.save(
+        entry["name"],
+        entry["file"],
+        entry["contributor"],
+        entry["intervals"],
+        entry["time"],
+    )
+    catalog.mark_annotated(work_queue.conn(), [entry["name"]])
+
+
+compact_journal(journal_file, replay)
+write_behind = WriteBehind(journal_file)
+
+# annotated logs written by earlier versions are full copies of the log,
+# their directory is listed once and they are recorded in the store
+if not store.legacy_recorded():
+    store.record_legacy(
+        (name, mapping.get(name, "Anonymous"))
+        for name in map(log_name, list_logs(output_csv_dir))
+    )
+
+# logs converted before the catalog existed are recorded once, from then on
+# the converter records them
+if catalog.count_logs(work_queue.conn()) == 0:
+    print(f"Recording the logs of {csv_dir} in the catalog...")
+    catalog.scan(work_queue.conn(), csv_dir)
+    # only hand out files which haven't been annotated, whatever their format
+    legacy, _ = store.legacy_logs()
+    catalog.mark_annotated(
+        work_queue.conn(),
+        {name for name, _, _ in store.annotated_logs()}
+        | {name for name, _ in legacy}
+        | set(mapping),
+    )
+
+# keep a few upcoming logs parsed in the background, started once the server
+# processes are forked
+def load_log(csv_path: str) -> pd.DataFrame:
+    with log_load_time.time():
+        return read_df(csv_path)
+
+
+def store_save(*args) -> None:
+    with save_store_time.time():
+        store.save(*args)
+
+
+prefetch = PrefetchPool(
+    partial(work_queue.take, prefetch_lease_s),
+    work_queue.release,
+    load_log,
+    work_queue.fail,
+)
+
+
+def load_viewed(csv_path: str):
+    # intervals_from_df finds no interval in converted logs, they only
+    # exist in the annotated copies of earlier versions
+    df = load_log(csv_path)
+    return df, intervals_from_df(df)
+
+
+# parsed logs of the read-only viewer, reviewers open the same logs again
+# and again
+viewer_cache = FrameCache(load_viewed)
 
 
 def rand_df_from_csv() -> Tuple[Optional[pd.DataFrame], str]:
-    if len(csv_paths) == 0:
-        return None, ""
-    rand_idx = np.random.randint(len(csv_paths))
-    # remove from list
-    csv_path = csv_paths.pop(rand_idx)
-    df = pd.read_csv(csv_path)
+    while True:
+        try:
+            df, csv_path = prefetch.get()
+        except Exception as error:
+            # the log is dropped from the queue, try the next one
+            print(f"Failed to open a log for annotation: {error!r}")
+            continue
+        if df is None:
+            return None, ""
+        # the lease of a prefetched log may have expired and the log handed
+        # out by another process, it is kept for lease_s from now on
+        if work_queue.renew(csv_path):
+            break
+        work_queue.release(csv_path)
     print(f"Opened {csv_path} for annotation")
     return df, csv_path
 
 
+def no_log_message() -> str:
+    # logs leased by other sessions come back to the queue if they are
+    # skipped or their lease expires
+    if work_queue.leased() > 0:
+        return (
+            "Every remaining log is being annotated right now, "
+            "please try again in a few minutes"
+        )
+    return "All files have been annotated. Thank you for contributing"
+
+
 class IndexHandler(RequestHandler):
     def get(self):
         self.write("Here have a cookie, 🍪")
 
 
+files_page = Template(
+    """<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8">
+  <title>Annotated files</title>
+  <style>
+    body { font-family: sans-serif; display: flex; flex-direction: column;
+           align-items: center; color: #222; }
+    .title { font-size: 1.8rem; font-weight: bold; color: #3498db; }
+    li { font-size: 1rem; margin: 0.2rem 0; }
+    a { color: #222; }
+    .muted { color: #888; }
+  </style>
+</head>
+<body>
+  <p class="title">Annotated files</p>
+  <form method="get" action="/files">
+    <input name="q" value="{{ search }}" placeholder="Log id or contributor">
+    <select name="sort">
+      {% for name in sorts %}
+      <option value="{{ name }}" {{ "selected" if name == sort else "" }}>
+        {{ name.replace("_", " ") }}
+      </option>
+      {% end %}
+    </select>
+    <button type="submit">Search</button>
+  </form>
+  {% if not items %}
+  <p>No annotated logs yet...</p>
+  {% end %}
+  <ul>
+    {% for name, annotator in items %}
+    <li><a href="/plot?{{ urlencode(dict(id=name)) }}">{{ name }}</a> (by {{ annotator }})</li>
+    {% end %}
+  </ul>
+  <p class="muted">
+    {% if page > 1 %}
+    <a href="/files?{{ urlencode(dict(q=search, sort=sort, page=page - 1)) }}">previous</a>
+    {% end %}
+    page {{ page }} of {{ num_pages }} ({{ total }} logs)
+    {% if page < num_pages %}
+    <a href="/files?{{ urlencode(dict(q=search, sort=sort, page=page + 1)) }}">next</a>
+    {% end %}
+  </p>
+</body>
+</html>
+"""
+)
+
+
+class MetricsHandler(RequestHandler):
+    """
+    Serves the metrics in the Prometheus text format, with several server
+    processes every scrape reaches one of them
+    """
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+class FilesHandler(RequestHandler):
+    """
+    Lists the annotated logs a page at a time, searched and sorted in the
+    annotation store
+    """
+
+    page_size = 50
+
+    def get(self):
+        search = self.get_argument("q", "").strip()
+        sort = self.get_argument("sort", "newest")
+        if sort not in sorts:
+            sort = "newest"
+        try:
+            page = max(int(self.get_argument("page", "1")), 1)
+        except ValueError:
+            page = 1
+        offset = (page - 1) * self.page_size
+
+        rows, num_stored = store.query(search, sort, self.page_size, offset)
+        items = [(name, annotator) for name, annotator, _ in rows]
+        # legacy copies that were not imported are listed after the stored
+        # logs
+        first = max(offset - num_stored, 0)
+        legacy, num_legacy = store.legacy_logs(
+            search, self.page_size - len(items), first
+        )
+        items += legacy
+        total = num_stored + num_legacy
+
+        self.write(
+            files_page.generate(
+                search=search,
+                sort=sort,
+                sorts=sorts,
+                items=items,
+                page=page,
+                num_pages=max((total + self.page_size - 1) // self.page_size, 1),
+                total=total,
+                urlencode=urlencode,
+            )
+        )
+
+
+@session_time.time()
 def annotate(doc: Document):
     stylesheet = InlineStyleSheet(
         css="""
@@ -141,7 +402,7 @@ def annotate(doc: Document):
 
     df, csv_path = rand_df_from_csv()
     if df is None:
-        title.text = "All files have been annotated. Thank you for contributing"
+        title.text = no_log_message()
         title.styles = {"flex-grow": "0"}
         doc.add_root(
             row(
@@ -152,7 +413,8 @@ def annotate(doc: Document):
             )
         )
         return
-    models = plot_df(df)
+    with plot_time.time():
+        models = plot_df(df, native=open_pyramid(log_name(csv_path)))
 
     def receive_box_data(attr, old, new):
         nonlocal df, csv_path
@@ -170,23 +432,33 @@ def annotate(doc: Document):
         save = new["data"].pop()  # second last entry indicates whether to save
 
         if save:
-            add_annotation(df, new["data"])
-            csv_loc = os.path.join(output_csv_dir, os.path.basename(csv_path))
-            print(f"Saving annotated file to {csv_loc}")
-            df.to_csv(csv_loc, index=False)
-
-            # TODO: move to a better way of storing contributor map
-            mapping[os.path.basename(csv_path)[:-4]] = name.value or "Anonymous"
-            with open(mapping_file, "w") as f:
-                json.dump(mapping, f)
+            # the save is safe once journaled, the annotated file is
+            # written in the background
+            with annotation_time.time():
+                intervals = clamp_ranges(new["data"], df.shape[0])
+            entry = {
+                "name": log_name(csv_path),
+                "file": os.path.basename(csv_path),
+                "contributor": name.value or "Anonymous",
+                "intervals": intervals,
+                "time": time.time(),
+            }
+            with save_journal_time.time():
+                write_behind.record(entry)
+            work_queue.complete(csv_path, entry["contributor"])
+            print(f"Saving annotations of {csv_path}")
+            write_behind.submit(
+                store_save,
+                entry["name"],
+                entry["file"],
+                entry["contributor"],
+                entry["intervals"],
+                entry["time"],
+            )
         else:
             # user didn't save annotated file, so add the file back to the list
-            csv_paths.append(csv_path)
+            work_queue.release(csv_path)
 
-        # clear plot
-        for model in models:
-            model.renderers = []
-            model.legend.items = []
         # load new data
         df, csv_path = rand_df_from_csv()
         if df is None:
@@ -198,10 +470,12 @@ def annotate(doc: Document):
             name.visible = False
             tutorial.visible = False
             loader.visible = False
-            title.text = "All files have been annotated. Thank you for contributing"
+            title.text = no_log_message()
             return
 
-        plot_df(df, models)
+        # swaps the data of the figures in place
+        with plot_time.time():
+            plot_df(df, models, native=open_pyramid(log_name(csv_path)))
         loader.visible = False
 
     # add listeners
@@ -276,12 +550,16 @@ def annotate(doc: Document):
         )
     )
 
+    def renew_lease():
+        # the callback stops with the session, the lease then expires
+        if csv_path and not work_queue.renew(csv_path):
+            print(f"Lost the lease of {csv_path}")
+
     def on_session_destroyed(session_context):
-        csv_loc = os.path.join(output_csv_dir, os.path.basename(csv_path))
-        if os.path.exists(csv_loc):
-            return
-        # user didn't save annotated file, so add the file back to the list
-        csv_paths.append(csv_path)
+        # user didn't save annotated file, so add the file back to the list,
+        # saved files are no longer leased
+        if csv_path:
+            work_queue.release(csv_path)
 
     doc.add_root(
         column(
@@ -305,86 +583,20 @@ def annotate(doc: Document):
             styles={"align-items": "center"},
         )
     )
+    doc.add_periodic_callback(renew_lease, renew_interval_s * 1000)
     doc.on_session_destroyed(on_session_destroyed)
 
 
-def annotated_files(doc: Document):
-    annotated_files = [
-        name[:-4] for name in os.listdir(output_csv_dir) if name.endswith(".csv")
-    ]
-    models = []
-    stylesheet = InlineStyleSheet(
-        css="""
-        .title {
-          font-size: 1.8rem;
-          font-weight: bold;
-          color: #3498db;
-        }
-
-        .bk-btn-group .bk-btn {
-            font-size: 1rem;
-            color: #222;
-            display: list-item;
-            padding: 0;
-            border: 0;
-            margin-left: 1.3rem;
-            list-style-type: disc;
-            outline: none;
-            text-decoration: underline;
-
-            &:hover {
-                cursor: pointer;
-                background: #fff;
-            }
-            &:active {
-                cursor: pointer;
-                background: #fff;
-                box-shadow: none;
-                outline: none;
-            }
-        }
-    """
-    )
-    title = Div(
-        text="Annotated files",
-        css_classes=["title"],
-    )
-    msg = Paragraph(text="No annotated logs yet...", visible=False)
-    for name in annotated_files:
-        li = Button(
-            label=f"{name} (by {mapping.get(name, 'Anonymous')})",
-            button_type="light",
-            stylesheets=[stylesheet],
-        )
-        li.js_on_click(
-            CustomJS(
-                args=dict(name=name),
-                code="""
-                    window.location="/plot?id=" + name
-                """,
-            )
-        )
-        models.append(li)
-
-    if len(models) == 0:
-        msg.visible = True
-    doc.add_root(
-        column(
-            title,
-            column(msg, *models),
-            sizing_mode="scale_width",
-            styles={"align-items": "center"},
-            stylesheets=[stylesheet],
-        )
-    )
-
-
+@session_time.time()
 def show_plot(doc: Document):
     args = doc.session_context.request.arguments
     id = args.get("id", [b""])[0].decode()
 
-    csv_path = os.path.join(output_csv_dir, id + ".csv")
-    if not os.path.exists(csv_path):
+    # annotated logs are plotted from the converted log and their intervals,
+    # logs annotated by earlier versions from their annotated copy
+    stored = store.has(id)
+    csv_path = find_log(csv_dir if stored else output_csv_dir, id)
+    if csv_path is None:
         msg = Div(
             text="Not found",
             visible=True,
@@ -398,9 +610,13 @@ def show_plot(doc: Document):
         doc.add_root(msg)
         return
 
-    df = pd.read_csv(csv_path)
-    models = plot_df(df, highlight=False)
-    annotate_plot(df, models)
+    df, df_intervals = viewer_cache.get(csv_path)
+    with plot_time.time():
+        models = plot_df(
+            df, highlight=False, native=open_pyramid(log_name(csv_path))
+        )
+    with annotation_time.time():
+        annotate_plot(store.intervals(id) if stored else df_intervals, models)
 
     doc.add_root(
         row(
@@ -411,11 +627,48 @@ def show_plot(doc: Document):
     )
 
 
+# with more than one process the server forks here, everything below runs in
+# each process
 server = Server(
-    {"/": annotate, "/files": annotated_files, "/plot": show_plot},
-    num_procs=1,
-    extra_patterns=[("/cookie", IndexHandler)],
+    {"/": annotate, "/plot": show_plot},
+    num_procs=arguments.num_procs,
+    websocket_compression_level=websocket_compression_level,
+    extra_patterns=[
+        ("/cookie", IndexHandler),
+        ("/files", FilesHandler),
+        ("/metrics", MetricsHandler),
+    ],
+)
+metrics.gauge("queue_depth", "Logs waiting to be annotated", lambda: len(work_queue))
+metrics.gauge(
+    "active_sessions",
+    "Open sessions of this process",
+    lambda: len(server.get_sessions()),
+)
+metrics.gauge(
+    "prefetched_frames", "Parsed logs waiting to be handed out", lambda: len(prefetch)
+)
+metrics.gauge(
+    "prefetched_bytes", "Memory of the prefetched logs", lambda: prefetch.nbytes
+)
+metrics.gauge(
+    "viewer_frames", "Parsed logs cached by the viewer", lambda: len(viewer_cache)
+)
+metrics.gauge(
+    "viewer_bytes",
+    "Memory of the logs cached by the viewer",
+    lambda: viewer_cache.nbytes,
+)
+metrics.counter(
+    "viewer_cache_hits_total", "Viewer cache hits", lambda: viewer_cache.hits
+)
+metrics.counter(
+    "viewer_cache_misses_total", "Viewer cache misses", lambda: viewer_cache.misses
+)
+metrics.gauge(
+    "pending_saves", "Journaled saves not stored yet", lambda: write_behind.pending
 )
+prefetch.start()
 server.start()
 
 if __name__ == "__main__":
@@ -426,4 +679,12 @@ if __name__ == "__main__":
     )
 
     server.io_loop.add_callback(view, "http://localhost:5006/")
-    server.io_loop.start()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        server.io_loop.asyncio_loop.add_signal_handler(signum, server.io_loop.stop)
+    try:
+        server.io_loop.start()
+    finally:
+        # the logs held by this process are handed out again right away
+        # instead of once their lease expires
+        prefetch.close()
+        work_queue.release_all()
@@ -0,0 +1,58 @@
+import os
+import threading
+import pandas as pd
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+Intervals = Dict[str, List[Tuple[int, int]]]
+
+
+class FrameCache:
+    """
+    LRU cache of parsed logs and their interval boxes for the read-only
+    viewer. Parsed logs count towards `max_bytes`, the least recently viewed
+    ones are dropped to stay under it. A log is cached along with the mtime
+    and size of its file, a file rewritten since is parsed again. `hits`
+    and `misses` count the lookups.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[str], Tuple[pd.DataFrame, Intervals]],
+        max_bytes: int = 256 * 2**20,
+    ):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path: str) -> Tuple[pd.DataFrame, Intervals]:
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+
+        df, intervals = self.load(path)
+        nbytes = int(df.memory_usage(index=False).sum())
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.nbytes -= old[3]
+            self.entries[path] = (stamp, df, intervals, nbytes)
+            self.nbytes += nbytes
+            # the log just parsed is kept even if it is over max_bytes alone
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, _, _, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted
+        return df, intervals
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Measures the bytes sent over the websocket when the annotation page moves
+from one log to the next, uncompressed and deflated like the server's
+websocket compression does. Both ways of moving to the next log are
+measured from the same page showing the first log,
+
+    old     every line is removed and drawn again at full resolution with a
+            data source of its own, int64 rows and float64 values (how the
+            server used to do it)
+    new     the decimated uint32/float32 data of every figure is swapped in
+            place (how the server does it now)
+
+    python3 server/measure_transport.py data/csv_files/<log> [<next log>]
+"""
+
+import os
+import sys
+import json
+import zlib
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from typing import Callable, List, Tuple
+
+from bokeh.document import Document
+from bokeh.layouts import column
+from bokeh.palettes import Dark2_5 as palette
+from bokeh.plotting import figure
+from bokeh.protocol import Protocol
+from plotting import figures, open_pyramid, plot_df
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(cwd, "../preprocessing"))
+from storage import log_name, read_df
+
+# same level as the server
+compression_level = 6
+
+
+def patch_bytes(doc: Document, change: Callable[[], None]) -> Tuple[int, int]:
+    """
+    returns the (raw, deflated) bytes of the document patches sent for the
+    changes `change` makes to `doc`
+    """
+    events = []
+    doc.on_change(events.append)
+    change()
+    doc.remove_on_change(events.append)
+
+    # the server sends every change as a message of its own
+    frames = []
+    for event in events:
+        message = Protocol().create("PATCH-DOC", [event])
+        frames += [message.header_json, message.metadata_json, message.content_json]
+        for buffer in message.buffers:
+            frames += [json.dumps(buffer.ref), buffer.to_bytes()]
+    frames = [f.encode() if isinstance(f, str) else bytes(f) for f in frames]
+
+    # permessage-deflate keeps one compression context per connection and
+    # flushes it after every frame
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = sum(
+        len(compressor.compress(f) + compressor.flush(zlib.Z_SYNC_FLUSH))
+        for f in frames
+    )
+    return sum(map(len, frames)), deflated
+
+
+def old_plot_df(df: pd.DataFrame, models: List = None) -> List:
+    """
+    draws the log like the server used to, every line gets a data source of
+    its own with every row of the log
+    """
+    colors = itertools.cycle(palette)
+    if not models:
+        models = [figure(width=1000, height=500, title=f["title"]) for f in figures]
+    for model, f in zip(models, figures):
+        model.renderers = []
+        for p in f["plots"]:
+            # logs used to be read from csv files as float64
+            y = df[p["col"]].to_numpy(dtype=np.float64)
+            model.line(
+                np.arange(y.shape[0]),
+                y,
+                color=next(colors),
+                legend_label=p["label"],
+                line_width=2,
+                alpha=0.7,
+            )
+    return models
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the bytes sent per log transition"
+    )
+    parser.add_argument("log")
+    parser.add_argument("next_log", nargs="?")
+    args = parser.parse_args()
+
+    next_log = args.next_log or args.log
+    df, next_df = read_df(args.log), read_df(next_log)
+
+    # every transition starts from a new page showing the first log
+    print(f"{'transition':<12}{'raw':>12}{'deflated':>12}")
+    doc = Document()
+    models = old_plot_df(df)
+    doc.add_root(column(*models))
+    raw, deflated = patch_bytes(doc, lambda: old_plot_df(next_df, models))
+    print(f"{'old':<12}{raw:>12}{deflated:>12}")
+
+    doc = Document()
+    models = plot_df(df, native=open_pyramid(log_name(args.log)))
+    doc.add_root(column(*models))
+    raw, deflated = patch_bytes(
+        doc,
+        lambda: plot_df(next_df, models, native=open_pyramid(log_name(next_log))),
+    )
+    print(f"{'new':<12}{raw:>12}{deflated:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# latency buckets in seconds, from a cached lookup to a slow log load
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """
+    Latency histogram, rendered as a cumulative Prometheus histogram
+    """
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self.lock:
+            self.counts[bisect.bisect_left(buckets, seconds)] += 1
+            self.sum += seconds
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self) -> List[str]:
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Metrics:
+    """
+    Registry of the metrics of a server process, histograms are observed as
+    requests are served while gauges and counters are read from their
+    callable when scraped
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.histograms: Dict[str, Histogram] = {}
+        self.sampled: List[Tuple[str, str, str, Callable[[], float]]] = []
+
+    def histogram(self, name: str, help: str) -> Histogram:
+        histogram = Histogram(f"{self.prefix}_{name}", help)
+        self.histograms[name] = histogram
+        return histogram
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> None:
+        self.sampled.append((f"{self.prefix}_{name}", help, "gauge", read))
+
+    def counter(self, name: str, help: str, read: Callable[[], float]) -> None:
+        self.sampled.append((f"{self.prefix}_{name}", help, "counter", read))
+
+    def render(self) -> str:
+        """
+        returns every metric in the Prometheus text format
+        """
+        lines = []
+        for histogram in self.histograms.values():
+            lines += histogram.render()
+        for name, help, type, read in self.sampled:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
@@ -1,11 +1,32 @@
-from typing import Any
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+import os
+import sys
+import weakref
 import numpy as np
 import pandas as pd
 import itertools
+from functools import partial
 from bokeh.plotting import figure
-from bokeh.models import CustomJS, Model, BoxAnnotation
+from bokeh.events import RangesUpdate
+from bokeh.models import CustomJS, Model, BoxAnnotation, ColumnDataSource, Range1d
 from bokeh.palettes import Dark2_5 as palette
 
+cwd = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(cwd, "../preprocessing"))
+from pyramid import build_levels, read_level
+
+pyramid_dir = os.path.join(cwd, "../data/pyramid_files")
+
+# lines are sent to the browser as at most about max_points min/max bins,
+# roughly one per pixel of a figure, whatever the length of the log. The
+# visible window is sent again at a finer level when a figure is zoomed or
+# panned
+max_points = 1000
+
+# pyramids, columns, data source and line renderers of the log currently
+# drawn in every figure
+views = weakref.WeakKeyDictionary()
+
 figures = [
     {
         "title": "Attitude.Pitch",
@@ -68,30 +89,213 @@ figures = [
 ]
 
 
-def plot_df(df: pd.DataFrame, models: Model = None, highlight: bool = True):
+class NativePyramid(Mapping):
+    """
+    Pyramid file written by the converter, its arrays are only read from
+    the file the first time they are used, so drawing a whole log only reads
+    the coarsest levels
+    """
+
+    def __init__(self, path: str):
+        self.npz = np.load(path)
+        self.arrays = {}
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        if key not in self.arrays:
+            self.arrays[key] = self.npz[key]
+        return self.arrays[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.npz.files
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.npz.files)
+
+    def __len__(self) -> int:
+        return len(self.npz.files)
+
+
+def open_pyramid(name: str) -> Optional[NativePyramid]:
+    """
+    returns the native rate pyramid of the log `name`, or None for logs
+    converted without one
+    """
+    path = os.path.join(pyramid_dir, name + ".npz")
+    if not os.path.exists(path):
+        return None
+    return NativePyramid(path)
+
+
+def build_pyramid(df: pd.DataFrame, columns: List[str]) -> Dict[str, np.ndarray]:
+    """
+    returns the decimation levels of `columns` over the row index, laid out
+    like the pyramid files written by the converter so read_level can be
+    used on them
+    """
+    # the arrays are sent as binary buffers as they are, uint32 rows and
+    # float32 values take half the bytes of int64/float64 ones
+    x = np.arange(df.shape[0], dtype=np.uint32)
+    pyramid = {"__columns__": np.array(columns, dtype=str)}
+    for i, col in enumerate(columns):
+        values = df[col].to_numpy(dtype=np.float32)
+        pyramid[f"c{i}.t"] = x
+        pyramid[f"c{i}.v"] = values
+        for k, (t, lo, hi) in enumerate(build_levels(x, values), start=1):
+            pyramid[f"c{i}.t{k}"] = t
+            pyramid[f"c{i}.min{k}"] = lo
+            pyramid[f"c{i}.max{k}"] = hi
+    return pyramid
+
+
+def decimate(
+    pyramid: Mapping[str, np.ndarray],
+    column: str,
+    start: float | None = None,
+    end: float | None = None,
+    timestamp: np.ndarray | None = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    returns the (x, y) points of `column` between rows `start` and `end` in
+    at most max_points bins. A native rate pyramid is indexed by timestamp,
+    `timestamp` holds the timestamps of the rows to go from one to the other
+    """
+    if timestamp is not None:
+        rows = np.arange(len(timestamp))
+        if start is not None:
+            start = np.interp(start, rows, timestamp)
+        if end is not None:
+            end = np.interp(end, rows, timestamp)
+    t, lo, hi = read_level(pyramid, column, max_points, start, end)
+    if len(t) > max_points:
+        # the coarsest level of a pyramid still has up to factor *
+        # min_points bins, they are merged down to max_points
+        starts = np.arange(0, len(t), -(-len(t) // max_points))
+        t = t[starts]
+        lo = np.minimum.reduceat(lo, starts)
+        hi = np.maximum.reduceat(hi, starts)
+    if timestamp is not None:
+        # native samples fall between the rows
+        t = np.interp(t, timestamp, rows).astype(np.float32)
+        lo = lo.astype(np.float32, copy=False)
+        hi = hi.astype(np.float32, copy=False)
+    if lo is hi:
+        return t, lo
+    # every bin is drawn as a vertical stroke from its min to its max, so
+    # spikes stay visible
+    return np.repeat(t, 2), np.column_stack((lo, hi)).ravel()
+
+
+def x_field(view: Dict[str, Any], col: str) -> str:
+    # the lines of the aligned log share one x column, native rate lines
+    # each have their own
+    return f"{col}.x" if col in view["native_columns"] else "x"
+
+
+def figure_data(
+    view: Dict[str, Any], start: float | None = None, end: float | None = None
+) -> Dict[str, np.ndarray]:
+    """
+    returns the data source columns of a figure, drawn from the native rate
+    pyramid of the log where it has the column
+    """
+    data = {}
+    for col in view["columns"]:
+        if col in view["native_columns"]:
+            x, data[col] = decimate(
+                view["native"], col, start, end, view["timestamp"]
+            )
+        else:
+            x, data[col] = decimate(view["pyramid"], col, start, end)
+        data[x_field(view, col)] = x
+    return data
+
+
+def make_view(
+    df: pd.DataFrame, columns: List[str], native: NativePyramid | None
+) -> Dict[str, Any]:
+    native_columns = []
+    if native is not None and "timestamp" in df:
+        native_columns = [c for c in columns if c in native["__columns__"]]
+    return {
+        "columns": columns,
+        "native": native,
+        "native_columns": native_columns,
+        "timestamp": df["timestamp"].to_numpy() if native_columns else None,
+        "pyramid": build_pyramid(
+            df, [c for c in columns if c not in native_columns]
+        ),
+    }
+
+
+def refine(fig: Model, event: RangesUpdate) -> None:
+    view = views.get(fig)
+    if view is None:
+        return
+    # half a window of margin on each side, small pans don't show gaps
+    margin = (event.x1 - event.x0) / 2
+    view["source"].data = figure_data(view, event.x0 - margin, event.x1 + margin)
+
+
+def plot_df(
+    df: pd.DataFrame,
+    models: Model = None,
+    highlight: bool = True,
+    native: NativePyramid | None = None,
+):
+    """
+    draws the log in new figures, or in the figures returned by an earlier
+    call. Figures and their line renderers are only created once, drawing
+    another log replaces the data of their sources. Lines are drawn from
+    the native rate pyramid `native` of the log where it has the column, so
+    zooming in shows every sample
+    """
     alpha = 0.7
     colors = itertools.cycle(palette)
+    last_row = max(df.shape[0] - 1, 1)
 
     for i, f in enumerate(figures):
-        if not models:
-            f["model"] = figure(width=1000, height=500, title=f["title"])
-        else:
+        columns = [p["col"] for p in f["plots"]]
+        view = make_view(df, columns, native)
+        data = figure_data(view)
+        if models:
             f["model"] = models[i]
-        for p in f["plots"]:
-            y = df[p["col"]]
-            x = np.arange(y.shape[0])
+            old = views[f["model"]]
+            view["source"] = old["source"]
+            view["renderers"] = old["renderers"]
+            views[f["model"]] = view
+            view["source"].data = data
+            for col, renderer in zip(columns, view["renderers"]):
+                renderer.glyph.x = x_field(view, col)
+            # zoom out to the whole log, and make reset do the same
+            f["model"].x_range.update(
+                start=0, end=last_row, reset_start=0, reset_end=last_row
+            )
+            continue
+
+        f["model"] = figure(
+            width=1000,
+            height=500,
+            title=f["title"],
+            x_range=Range1d(0, last_row),
+        )
+        view["source"] = ColumnDataSource(data=data)
+        view["renderers"] = [
             f["model"].line(
-                x,
-                y,
+                x_field(view, p["col"]),
+                p["col"],
+                source=view["source"],
                 color=next(colors),
                 legend_label=p["label"],
                 line_width=2,
                 alpha=alpha,
             )
-        if not models:
-            f["model"].legend.click_policy = "hide"
-            if highlight:
-                enable_highlight(f["model"], figname=f["title"])
+            for p in f["plots"]
+        ]
+        views[f["model"]] = view
+        f["model"].on_event(RangesUpdate, partial(refine, f["model"]))
+        f["model"].legend.click_policy = "hide"
+        if highlight:
+            enable_highlight(f["model"], figname=f["title"])
 
     return [f["model"] for f in figures]
 
@@ -134,9 +338,21 @@ def enable_highlight(fig: Model, figname: str):
     fig.js_on_event("panend", callback)
 
 
-def annotate_plot(df: pd.DataFrame, models: Any):
-    anomaly_cols = ["anomaly." + f["title"] for f in figures]
-    for i, anomaly_col in enumerate(anomaly_cols):
+def annotate_plot(intervals: Dict[str, List[Tuple[int, int]]], models: Any):
+    # intervals hold the (first row, last row) of every anomaly by figure title
+    for i, f in enumerate(figures):
+        for left, right in intervals.get(f["title"], []):
+            box = BoxAnnotation(
+                left=left, right=right, fill_alpha=0.5, fill_color="green"
+            )
+            models[i].add_layout(box)
+
+
+def intervals_from_df(df: pd.DataFrame) -> Dict[str, List[Tuple[int, int]]]:
+    # recovers the intervals of a log annotated with boolean columns
+    intervals = {}
+    for f in figures:
+        anomaly_col = "anomaly." + f["title"]
         if df.get(anomaly_col) is None:
             continue
         arr = df[anomaly_col].to_numpy()
@@ -147,11 +363,8 @@ def annotate_plot(df: pd.DataFrame, models: Any):
             start = [0] + start  # start with True
         if arr[-1] == 1:
             end = end + [len(arr)]  # ends with True
-        for left, right in zip(start, end):
-            box = BoxAnnotation(
-                left=left, right=right - 1, fill_alpha=0.5, fill_color="green"
-            )
-            models[i].add_layout(box)
+        intervals[f["title"]] = [(left, right - 1) for left, right in zip(start, end)]
+    return intervals
 
 
 def add_annotation(df: pd.DataFrame, data: Any):
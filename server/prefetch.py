@@ -0,0 +1,139 @@
+import threading
+import pandas as pd
+from collections import deque
+from typing import Callable, Optional, Tuple
+
+
+class PrefetchPool:
+    """
+    Keeps up to `size` logs taken from the work queue already parsed in
+    memory, so the next log can be handed out without parsing it on the IO
+    loop. A worker thread refills the pool, a log is reserved (removed from
+    the work queue) before it is parsed so it is never handed out twice.
+    Parsed logs count towards `max_bytes`, a log that would go over it is
+    evicted and given back to the work queue. A log that fails to parse is
+    dropped from the work queue.
+    """
+
+    def __init__(
+        self,
+        take: Callable[[], Optional[str]],
+        give_back: Callable[[str], None],
+        load: Callable[[str], pd.DataFrame],
+        drop: Callable[[str], None],
+        size: int = 4,
+        max_bytes: int = 512 * 2**20,
+        poll_interval: float = 5.0,
+    ):
+        self.take = take
+        self.give_back = give_back
+        self.load = load
+        self.drop = drop
+        self.size = size
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+
+        self.ready = deque()
+        self.nbytes = 0
+        self.loading = 0
+        self.evicted = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.worker = threading.Thread(target=self._fill, daemon=True)
+
+    def start(self) -> None:
+        self.worker.start()
+
+    def _full(self) -> bool:
+        # after an eviction the pool waits for a log to be handed out
+        return (
+            len(self.ready) >= self.size
+            or (len(self.ready) > 0 and self.nbytes >= self.max_bytes)
+            or self.evicted
+        )
+
+    def _fill(self) -> None:
+        # the work queue is a database shared with other processes, it is
+        # never used while holding the lock the IO loop waits on
+        while True:
+            with self.cond:
+                while self._full() and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            path = self.take()
+            if path is None:
+                # files may come back to the queue later on
+                with self.cond:
+                    self.cond.wait(self.poll_interval)
+                continue
+            with self.cond:
+                self.loading += 1
+
+            df = None
+            try:
+                df = self.load(path)
+            except Exception as error:
+                print(f"Failed to prefetch {path}: {error!r}")
+                self.drop(path)
+
+            give_back = False
+            with self.cond:
+                self.loading -= 1
+                if df is not None:
+                    nbytes = int(df.memory_usage(index=False).sum())
+                    if self.closed:
+                        give_back = True
+                    elif len(self.ready) > 0 and self.nbytes + nbytes > self.max_bytes:
+                        # evict, the log is parsed again once there is room
+                        give_back = True
+                        self.evicted = True
+                    else:
+                        self.ready.append((df, path, nbytes))
+                        self.nbytes += nbytes
+                self.cond.notify_all()
+            if give_back:
+                self.give_back(path)
+
+    def get(self) -> Tuple[Optional[pd.DataFrame], str]:
+        """
+        returns the next parsed log and its path, or (None, "") once the
+        work queue is empty. Falls back to parsing on the calling thread when
+        the pool is empty, a log that fails to parse there is dropped and its
+        error raised
+        """
+        with self.cond:
+            # a log being parsed may be the last one left
+            while len(self.ready) == 0 and self.loading > 0:
+                self.cond.wait()
+            if len(self.ready) > 0:
+                df, path, nbytes = self.ready.popleft()
+                self.nbytes -= nbytes
+                self.evicted = False
+                self.cond.notify_all()
+                return df, path
+        path = self.take()
+        if path is None:
+            return None, ""
+        try:
+            return self.load(path), path
+        except Exception:
+            self.drop(path)
+            raise
+
+    def close(self) -> None:
+        """
+        stops refilling the pool and gives the parsed logs back to the work
+        queue
+        """
+        with self.cond:
+            self.closed = True
+            paths = [path for _, path, _ in self.ready]
+            self.ready.clear()
+            self.nbytes = 0
+            self.cond.notify_all()
+        for path in paths:
+            self.give_back(path)
+
+    def __len__(self) -> int:
+        return len(self.ready)
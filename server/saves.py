@@ -0,0 +1,77 @@
+import os
+import json
+import fcntl
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+
+class WriteBehind:
+    """
+    Persists annotation saves off the IO loop. A save is first appended to
+    a journal (an append-only json lines file, fsynced) and is safe from
+    then on, the rest of the save is done by a single background thread so
+    saves are stored in the order they were made. Saves that never made it
+    to the store are stored again from the journal on startup.
+    """
+
+    def __init__(self, journal_path: str):
+        self.journal_path = journal_path
+        self.journal = open(journal_path, "a")
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = 0
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            # other processes sharing the journal may be compacting it
+            fcntl.flock(self.journal, fcntl.LOCK_EX)
+            try:
+                self.journal.write(line)
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+            finally:
+                fcntl.flock(self.journal, fcntl.LOCK_UN)
+
+    def submit(self, fn: Callable[..., None], *args: Any) -> Future:
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self.lock:
+            self.pending -= 1
+        error = future.exception()
+        if error is not None:
+            print(f"Failed to save annotated file: {error!r}")
+
+
+def compact_journal(
+    journal_path: str, apply: Callable[[Dict[str, Any]], None]
+) -> int:
+    """
+    stores the journal entries with `apply` and empties the journal, so the
+    next startup only replays the saves made since. A line cut short by a
+    crash is skipped. Returns the number of entries
+    """
+    with open(journal_path, "a+") as f:
+        # no process appends to the journal until it is emptied
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        n_entries = 0
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            apply(entry)
+            n_entries += 1
+        # the entries are stored, a crash before this point replays them
+        # again
+        f.truncate(0)
+        f.flush()
+        os.fsync(f.fileno())
+    return n_entries
@@ -0,0 +1,158 @@
+import os
+import sys
+import time
+import uuid
+import sqlite3
+import threading
+from typing import Optional
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(cwd, "../preprocessing"))
+import catalog
+from catalog import DONE, FAILED, LEASED, PENDING
+
+
+class WorkQueue:
+    """
+    Queue of the logs to annotate shared by every server process through
+    the catalog of converted logs, logs recorded by the converter are
+    queued from then on. A log is handed out with a lease that has to be
+    renewed while it is in use; a log whose lease expired (its process
+    crashed or its session went away unnoticed) goes back to the queue on
+    its own. Logs are stored by file name relative to `csv_dir`. The
+    catalog is in WAL mode, which needs every process on the same host.
+    """
+
+    def __init__(self, db_path: str, csv_dir: str, lease_s: float = 600):
+        self.db_path = db_path
+        self.csv_dir = csv_dir
+        self.lease_s = lease_s
+        self.local = threading.local()
+        # leases taken by this process
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def conn(self) -> sqlite3.Connection:
+        # connections are never shared between threads or forked processes
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.conn = catalog.connect(self.db_path)
+            self.local.conn.isolation_level = None
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def take(self, lease_s: Optional[float] = None) -> Optional[str]:
+        """
+        leases a random pending (or expired) log for `lease_s` (the queue's
+        lease by default) and returns its path, or None when there is no log
+        left
+        """
+        if lease_s is None:
+            lease_s = self.lease_s
+        now = time.time()
+        lease = uuid.uuid4().hex
+        conn = self.conn()
+        # the write lock is taken up front so two processes can't pick the
+        # same log
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """
+                SELECT file FROM logs
+                WHERE status = ? OR (status = ? AND lease_expires < ?)
+                ORDER BY random() LIMIT 1
+                """,
+                (PENDING, LEASED, now),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE logs SET status = ?, lease = ?, lease_expires = ? "
+                    "WHERE file = ?",
+                    (LEASED, lease, now + lease_s, row[0]),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        path = os.path.join(self.csv_dir, row[0])
+        with self.lock:
+            self.leases[path] = lease
+        return path
+
+    def _update(self, path: str, sql: str, *params) -> bool:
+        with self.lock:
+            lease = self.leases.get(path)
+        if lease is None:
+            return False
+        cursor = self.conn().execute(
+            sql + " WHERE file = ? AND lease = ?",
+            (*params, os.path.basename(path), lease),
+        )
+        return cursor.rowcount > 0
+
+    def renew(self, path: str) -> bool:
+        """
+        extends the lease of a log, returns False once the lease was lost
+        """
+        return self._update(
+            path, "UPDATE logs SET lease_expires = ?", time.time() + self.lease_s
+        )
+
+    def release(self, path: str) -> None:
+        """
+        puts a leased log back in the queue
+        """
+        self._update(path, "UPDATE logs SET status = ?, lease = NULL", PENDING)
+        with self.lock:
+            self.leases.pop(path, None)
+
+    def release_all(self) -> None:
+        """
+        puts every log leased by this process back in the queue
+        """
+        with self.lock:
+            paths = list(self.leases)
+        for path in paths:
+            self.release(path)
+
+    def fail(self, path: str) -> None:
+        """
+        takes a leased log that can't be read out of the queue, it is handed
+        out again once it is converted again
+        """
+        self._update(path, "UPDATE logs SET status = ?, lease = NULL", FAILED)
+        with self.lock:
+            self.leases.pop(path, None)
+
+    def complete(self, path: str, annotator: str) -> None:
+        """
+        marks a log as annotated by `annotator`, it is never handed out again
+        """
+        self.conn().execute(
+            "UPDATE logs SET status = ?, annotator = ?, lease = NULL WHERE file = ?",
+            (DONE, annotator, os.path.basename(path)),
+        )
+        with self.lock:
+            self.leases.pop(path, None)
+
+    def __len__(self) -> int:
+        """
+        returns the number of logs that can be handed out
+        """
+        row = self.conn().execute(
+            "SELECT count(*) FROM logs WHERE status = ? "
+            "OR (status = ? AND lease_expires < ?)",
+            (PENDING, LEASED, time.time()),
+        ).fetchone()
+        return row[0]
+
+    def leased(self) -> int:
+        """
+        returns the number of logs currently leased, by any process
+        """
+        row = self.conn().execute(
+            "SELECT count(*) FROM logs WHERE status = ? AND lease_expires >= ?",
+            (LEASED, time.time()),
+        ).fetchone()
+        return row[0]
@@ -0,0 +1,86 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# the preprocessing scripts and the server import their modules by name
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(root, "preprocessing"))
+sys.path.append(os.path.join(root, "server"))
+
+
+class StandIn:
+    """
+    local stand-in for the flight review server, serves `files` (path to
+    bytes) with range requests and conditional requests and records the
+    headers of every request
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.etags = {}
+        self.last_modified = {}
+        self.requests = []
+        # shifts the first byte reported in Content-Range, like a server
+        # that answers a different range than the one asked for
+        self.range_shift = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stand_in.requests.append((self.path, dict(self.headers)))
+                body = stand_in.files.get(self.path)
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                etag = stand_in.etags.get(self.path)
+                last_modified = stand_in.last_modified.get(self.path)
+                if etag is not None and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                status, first = 200, 0
+                if self.headers.get("Range"):
+                    first = int(self.headers["Range"][len("bytes=") :].rstrip("-"))
+                    if first >= len(body):
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{len(body)}")
+                        self.end_headers()
+                        return
+                    status = 206
+                self.send_response(status)
+                if status == 206:
+                    shown = first + stand_in.range_shift
+                    self.send_header(
+                        "Content-Range", f"bytes {shown}-{len(body) - 1}/{len(body)}"
+                    )
+                if etag is not None:
+                    self.send_header("ETag", etag)
+                if last_modified is not None:
+                    self.send_header("Last-Modified", last_modified)
+                self.send_header("Content-Length", str(len(body) - first))
+                self.end_headers()
+                self.wfile.write(body[first:])
+
+        return Handler
+
+
+@pytest.fixture
+def stand_in():
+    stand_in = StandIn()
+    thread = threading.Thread(target=stand_in.server.serve_forever, daemon=True)
+    thread.start()
+    yield stand_in
+    stand_in.server.shutdown()
+    stand_in.server.server_close()
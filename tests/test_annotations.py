@@ -0,0 +1,24 @@
+from annotations import AnnotationStore, clamp_ranges
+
+
+def test_legacy_logs(tmp_path):
+    store = AnnotationStore(str(tmp_path / "annotations.sqlite"))
+    assert not store.legacy_recorded()
+    store.record_legacy([("log_a", "alice"), ("log_b", "bob"), ("log_c", "Anonymous")])
+    assert store.legacy_recorded()
+
+    # imported copies are listed from the store only
+    store.save("log_b", "log_b.feather", "bob", [("Attitude.Roll", 1, 5)])
+    assert store.legacy_logs() == ([("log_a", "alice"), ("log_c", "Anonymous")], 2)
+    assert store.legacy_logs("ALI") == ([("log_a", "alice")], 1)
+    assert store.legacy_logs("", 1, 1) == ([("log_c", "Anonymous")], 2)
+    assert store.legacy_logs("%") == ([], 0)
+
+
+def test_clamp_ranges_drops_boxes_outside_the_log():
+    data = [["Attitude.Roll", [[-20, -5], [-3, 4], [8, 12], [95, 120], [130, 140]]]]
+    assert clamp_ranges(data, 100) == [
+        ("Attitude.Roll", 0, 4),
+        ("Attitude.Roll", 8, 12),
+        ("Attitude.Roll", 95, 99),
+    ]
@@ -0,0 +1,68 @@
+import json
+
+import log_db
+from download_logs import sync_db_info
+
+
+def entry(log_id, duration_s, rating="good"):
+    return {
+        "log_id": log_id,
+        "duration_s": duration_s,
+        "source": "webui",
+        "rating": rating,
+        "flight_modes": [3],
+    }
+
+
+def ids(entries):
+    return sorted(entry["log_id"] for entry in entries)
+
+
+def test_sync(stand_in, tmp_path):
+    conn = log_db.connect(str(tmp_path / "db_info.sqlite"))
+    url = stand_in.url + "/dbinfo"
+    last_modified = "Tue, 01 Oct 2024 00:00:00 GMT"
+    stand_in.files["/dbinfo"] = json.dumps([entry("a", 100), entry("b", 200)]).encode()
+    stand_in.etags["/dbinfo"] = '"v1"'
+    stand_in.last_modified["/dbinfo"] = last_modified
+
+    sync_db_info(conn, url)
+    assert log_db.count_entries(conn) == 2
+    assert log_db.sync_generation(conn, url) == 1
+
+    # unchanged, the conditional request gets a 304 and nothing is merged
+    sync_db_info(conn, url)
+    headers = stand_in.requests[-1][1]
+    assert headers["If-None-Match"] == '"v1"'
+    assert headers["If-Modified-Since"] == last_modified
+    assert log_db.sync_generation(conn, url) == 1
+
+    # one new and one changed log
+    stand_in.files["/dbinfo"] = json.dumps(
+        [entry("a", 100), entry("b", 200, rating="crashed"), entry("c", 300)]
+    ).encode()
+    stand_in.etags["/dbinfo"] = '"v2"'
+    sync_db_info(conn, url)
+    assert log_db.count_entries(conn) == 3
+    generation = log_db.sync_generation(conn, url)
+    assert generation == 2
+
+    new = log_db.query_entries(conn, url, None, None, {}, generation)
+    assert ids(new) == ["b", "c"]
+    assert ids(log_db.query_entries(conn, url, None, None, {})) == ["a", "b", "c"]
+    assert ids(log_db.query_entries(conn, url, None, None, {}, 1)) == ["a"]
+
+
+def test_query_only_the_active_db_info(tmp_path):
+    conn = log_db.connect(str(tmp_path / "db_info.sqlite"))
+    first, second = tmp_path / "first.json", tmp_path / "second.json"
+    no_source = {"log_id": "c", "duration_s": 300, "source": None}
+    simulated = dict(entry("d", 400), source="QGroundControl")
+    first.write_text(json.dumps([entry("a", 100), no_source, simulated]))
+    second.write_text(json.dumps([entry("b", 200)]))
+    log_db.ingest(conn, str(first))
+    log_db.ingest(conn, str(second))
+
+    # logs without a source are kept, simulated ones are not
+    assert ids(log_db.query_entries(conn, "first.json", None, None, {})) == ["a", "c"]
+    assert ids(log_db.query_entries(conn, "second.json", None, None, {})) == ["b"]
@@ -0,0 +1,68 @@
+import os
+
+import requests
+
+from download_logs import (
+    RateLimiter,
+    fetch_log,
+    is_permanent,
+    make_session,
+    ulog_magic,
+)
+
+log = ulog_magic + b"\x00" * 9 + bytes(range(256)) * 40
+
+
+def fetch(stand_in, tmp_path):
+    stand_in.files["/download?log=abc"] = log
+    file_path = os.path.join(tmp_path, "abc.ulg")
+    num_bytes = fetch_log(
+        make_session(1), RateLimiter(0), stand_in.url + "/download?log=abc", file_path
+    )
+    with open(file_path, "rb") as f:
+        assert f.read() == log
+    assert not os.path.exists(os.path.join(tmp_path, ".abc.part"))
+    return num_bytes
+
+
+def write_part(tmp_path, data):
+    with open(os.path.join(tmp_path, ".abc.part"), "wb") as f:
+        f.write(data)
+
+
+def test_fetch(stand_in, tmp_path):
+    assert fetch(stand_in, tmp_path) == len(log)
+    assert "Range" not in stand_in.requests[0][1]
+
+
+def test_resume(stand_in, tmp_path):
+    write_part(tmp_path, log[:1000])
+    assert fetch(stand_in, tmp_path) == len(log) - 1000
+    assert stand_in.requests[0][1]["Range"] == "bytes=1000-"
+
+
+def test_complete_part_starts_over(stand_in, tmp_path):
+    # a run killed after writing the whole log but before renaming it
+    write_part(tmp_path, log)
+    assert fetch(stand_in, tmp_path) == len(log)
+    assert len(stand_in.requests) == 2
+
+
+def test_mismatched_range_starts_over(stand_in, tmp_path):
+    write_part(tmp_path, log[:1000])
+    stand_in.range_shift = 10
+    # the range is only asked for while resuming
+    assert fetch(stand_in, tmp_path) == len(log)
+    assert "Range" not in stand_in.requests[-1][1]
+
+
+def test_range_errors_are_not_permanent():
+    def error(status):
+        response = requests.Response()
+        response.status_code = status
+        return requests.HTTPError(response=response)
+
+    assert is_permanent(error(404))
+    assert not is_permanent(error(416))
+    assert not is_permanent(error(429))
+    assert not is_permanent(error(503))
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+import plotting
+from plotting import build_pyramid, decimate, figures, open_pyramid, plot_df, views
+from pyramid import write_pyramid
+
+columns = [p["col"] for f in figures for p in f["plots"]]
+
+
+def make_log(tmp_path, num_rows, rate):
+    """
+    writes the native rate pyramid of a log sampled `rate` times faster
+    than its 10 Hz aligned frame, returns the aligned frame
+    """
+    rng = np.random.default_rng(0)
+    timestamp = np.arange(num_rows, dtype=np.int64) * 100_000
+    native_t = np.arange(num_rows * rate, dtype=np.int64) * (100_000 // rate)
+    series = [
+        (native_t, rng.normal(size=len(native_t)).astype(np.float32))
+        for _ in columns
+    ]
+    write_pyramid(str(tmp_path / "log.npz"), columns, series)
+    df = pd.DataFrame({"timestamp": timestamp})
+    for col, (_, values) in zip(columns, series):
+        df[col] = values[::rate]
+    return df
+
+
+def test_whole_log_fits_in_max_points():
+    # build_levels stops below factor * min_points bins
+    df = pd.DataFrame({"a": np.arange(3999, dtype=np.float32)})
+    x, y = decimate(build_pyramid(df, ["a"]), "a")
+    assert len(x) <= 2 * plotting.max_points
+    assert y.min() == 0 and y.max() == 3998
+
+
+def test_zoom_shows_native_samples(tmp_path, monkeypatch):
+    monkeypatch.setattr(plotting, "pyramid_dir", str(tmp_path))
+    df = make_log(tmp_path, 3000, rate=20)
+    native = open_pyramid("log")
+    models = plot_df(df, native=native)
+    view = views[models[0]]
+    col = view["columns"][0]
+    assert col in view["native_columns"]
+
+    data = view["source"].data
+    assert len(data[col]) <= 2 * plotting.max_points
+    assert data[f"{col}.x"].min() >= 0 and data[f"{col}.x"].max() <= 2999
+
+    # 20 rows hold 400 native samples, all of them are drawn
+    x, y = decimate(native, col, 100, 120, view["timestamp"])
+    assert len(x) >= 400
+    assert np.all((x >= 100) & (x <= 120))
+    assert x.dtype == np.float32
+
+    # another log without a pyramid goes back to the shared x column
+    plot_df(df, models)
+    assert views[models[0]]["renderers"][0].glyph.x == "x"
+    assert "x" in views[models[0]]["source"].data
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from resample import bin_mean, sample_hold
+
+
+def bin_mean_loop(values, timestamp, target):
+    # compress() before it was vectorized
+    idx = np.searchsorted(timestamp, target, side="right")
+    start = 0
+    final = np.zeros_like(target, dtype=np.float32)
+    for j, i in enumerate(idx):
+        if i > start:
+            final[j] = values[start:i].mean()
+        else:
+            final[j] = values[start if start < len(values) else -1]
+        start = i
+    return final
+
+
+def sample_hold_loop(values, timestamp, target):
+    # expand() before it was vectorized
+    idx = np.searchsorted(timestamp, target, side="left")
+    final = np.zeros_like(target, dtype=np.float32)
+    for j, i in enumerate(idx):
+        final[j] = values[i if i < len(values) else -1]
+    return final
+
+
+def random_case(rng, dtype):
+    n = int(rng.integers(1, 300))
+    m = int(rng.integers(0, 100))
+    # few distinct timestamps so bins are often empty and targets repeat,
+    # targets may run past the end of the samples
+    timestamp = np.sort(rng.integers(0, 500, n))
+    target = np.sort(rng.integers(0, 700, m))
+    values = rng.normal(0, 100, n).astype(dtype)
+    return values, timestamp, target
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_bin_mean_matches_loop(dtype):
+    rng = np.random.default_rng(0)
+    for _ in range(1000):
+        values, timestamp, target = random_case(rng, dtype)
+        np.testing.assert_array_equal(
+            bin_mean(values, timestamp, target),
+            bin_mean_loop(values, timestamp, target),
+        )
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_sample_hold_matches_loop(dtype):
+    rng = np.random.default_rng(1)
+    for _ in range(1000):
+        values, timestamp, target = random_case(rng, dtype)
+        np.testing.assert_array_equal(
+            sample_hold(values, timestamp, target),
+            sample_hold_loop(values, timestamp, target),
+        )
+
+
+def test_empty_bins_and_tail():
+    values = np.array([1, 2, 3, 4], dtype=np.float32)
+    timestamp = np.array([10, 20, 30, 40])
+    target = np.array([5, 20, 20, 35, 50, 60])
+    np.testing.assert_array_equal(
+        bin_mean(values, timestamp, target), [1, 1.5, 3, 3, 4, 4]
+    )
+    np.testing.assert_array_equal(
+        sample_hold(values, timestamp, target), [1, 2, 2, 4, 4, 4]
+    )
@@ -0,0 +1,26 @@
+from saves import WriteBehind, compact_journal
+
+
+def entry(name):
+    return {"name": name, "file": name + ".feather", "contributor": "someone"}
+
+
+def test_compact_journal(tmp_path):
+    journal = str(tmp_path / "mapping.jsonl")
+    write_behind = WriteBehind(journal)
+    write_behind.record(entry("a"))
+    write_behind.record(entry("b"))
+    # a line cut short by a crash
+    with open(journal, "a") as f:
+        f.write('{"name": "c", "fi')
+
+    applied = []
+    assert compact_journal(journal, applied.append) == 2
+    assert [e["name"] for e in applied] == ["a", "b"]
+    assert open(journal).read() == ""
+
+    # saves made after the compaction are the only ones replayed
+    write_behind.record(entry("d"))
+    applied = []
+    assert compact_journal(journal, applied.append) == 1
+    assert [e["name"] for e in applied] == ["d"]
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from manifest import load_manifest, save_manifest
+from storage import FORMATS, log_path, migrate, read_df, write_df_atomic
+
+
+def make_df(num_rows=500):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            "timestamp": np.arange(num_rows, dtype=np.int64) * 100_000,
+            "vehicle_attitude.roll": rng.normal(size=num_rows).astype(np.float32),
+            "sensor_combined.accelerometer_m_s2[0]": rng.normal(
+                size=num_rows
+            ).astype(np.float32),
+        }
+    )
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_round_trip(tmp_path, fmt):
+    df = make_df()
+    path = log_path(str(tmp_path), "log", fmt)
+    write_df_atomic(df, path)
+    # no temporary file is left behind
+    assert [p.name for p in tmp_path.iterdir()] == ["log" + FORMATS[fmt]]
+    # csv reads the float32 columns back as float64
+    pd.testing.assert_frame_equal(read_df(path), df, check_dtype=fmt != "csv")
+
+
+def test_reads_lz4_feather(tmp_path):
+    # logs written by earlier versions are lz4 compressed
+    df = make_df()
+    path = log_path(str(tmp_path), "log", "feather")
+    df.to_feather(path, compression="lz4")
+    pd.testing.assert_frame_equal(read_df(path), df)
+
+
+def test_migrate_updates_manifest(tmp_path):
+    df = make_df()
+    write_df_atomic(df, log_path(str(tmp_path), "log", "csv"))
+    entry = {"output": "log.csv", "output_size": 0, "output_sha256": "", "spec": "s"}
+    save_manifest(str(tmp_path / "manifest.json"), {"log.ulg": entry})
+
+    assert migrate(str(tmp_path), "feather") == 1
+    entry = load_manifest(str(tmp_path / "manifest.json"))["log.ulg"]
+    assert entry["output"] == "log.feather"
+    assert entry["output_size"] == (tmp_path / "log.feather").stat().st_size
+    assert entry["spec"] == "s"
+    assert not (tmp_path / "log.csv").exists()
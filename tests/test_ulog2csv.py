@@ -0,0 +1,96 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import catalog
+import ulog2csv
+from ulog2csv import EXISTS, FAILED, MISSING, SHORT
+
+
+def convert_or_die(ulog_path, entry=None, fmt=None, report_memory=False):
+    if "crash" in ulog_path:
+        # like a worker killed for running out of memory
+        os._exit(1)
+    time.sleep(0.05)
+    return EXISTS, f"File {ulog_path} already processed, skipping...", None
+
+
+def test_dead_worker_fails_only_its_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(ulog2csv, "convert_file", convert_or_die)
+    monkeypatch.setattr(ulog2csv, "manifest_file", str(tmp_path / "manifest.json"))
+    monkeypatch.setattr(ulog2csv, "rejected_file", str(tmp_path / "rejected.json"))
+    paths = [f"log{i}.ulg" for i in range(12)]
+    paths[2] = "crash.ulg"
+
+    statuses = {}
+    summary = ulog2csv.convert_all(
+        paths, jobs=2, on_result=lambda path, status: statuses.update({path: status})
+    )
+    assert statuses["crash.ulg"] == FAILED
+    assert sum(summary.values()) == len(paths)
+    # the rest of the batch is converted by a new pool
+    assert statuses[paths[-1]] == EXISTS
+
+
+class StubULog:
+    """
+    ULog with only the datasets in `datasets`, looked up like pyulog does
+    """
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+
+    def get_dataset(self, name):
+        return [d for n, d in self.datasets.items() if n == name][0]
+
+
+class StubDataset:
+    def __init__(self, data):
+        self.data = data
+
+
+class StubPX4ULog:
+    def add_roll_pitch_yaw(self):
+        pass
+
+
+def convert_stub(tmp_path, monkeypatch, datasets):
+    ulog_path = tmp_path / "log.ulg"
+    ulog_path.write_bytes(b"ulog")
+    monkeypatch.setattr(ulog2csv, "catalog_file", str(tmp_path / "catalog.sqlite"))
+    monkeypatch.setattr(ulog2csv, "_catalog", None)
+    monkeypatch.setattr(ulog2csv, "ULog", lambda path, filter: StubULog(datasets))
+    monkeypatch.setattr(ulog2csv, "PX4ULog", lambda ulog: StubPX4ULog())
+    return ulog2csv._convert_file(str(ulog_path), None, "feather")
+
+
+def test_no_vehicle_status_is_rejected(tmp_path, monkeypatch):
+    status, msg, entry = convert_stub(tmp_path, monkeypatch, {})
+    assert status == MISSING and "vehicle_status" in msg and entry is None
+
+
+def test_no_mission_is_rejected(tmp_path, monkeypatch):
+    vehicle_status = StubDataset(
+        {"timestamp": np.arange(5) * 100_000, "nav_state": np.array([2, 2, 4, 4, 2])}
+    )
+    status, _, entry = convert_stub(
+        tmp_path, monkeypatch, {"vehicle_status": vehicle_status}
+    )
+    assert status == SHORT and entry is None
+
+
+def test_annotated_log_is_kept(tmp_path, monkeypatch):
+    # a new spec would reject the log, its converted log stays as it is
+    conn = catalog.connect(str(tmp_path / "catalog.sqlite"))
+    catalog.record_log(conn, str(tmp_path / "log.feather"), pd.DataFrame())
+    catalog.mark_annotated(conn, ["log"])
+    entry = {"output": "log.feather", "spec": "old"}
+    monkeypatch.setattr(ulog2csv, "catalog_file", str(tmp_path / "catalog.sqlite"))
+    monkeypatch.setattr(ulog2csv, "_catalog", None)
+    ulog_path = tmp_path / "log.ulg"
+    ulog_path.write_bytes(b"ulog")
+
+    status, _, kept = ulog2csv._convert_file(str(ulog_path), entry, "feather")
+    assert status == EXISTS and kept is entry
@@ -0,0 +1,90 @@
+import time
+
+import pandas as pd
+
+import catalog
+from prefetch import PrefetchPool
+from work_queue import WorkQueue
+
+
+def make_queue(tmp_path, num_logs):
+    db_path = str(tmp_path / "catalog.sqlite")
+    conn = catalog.connect(db_path)
+    df = pd.DataFrame({"timestamp": [0, 100_000]})
+    for i in range(num_logs):
+        catalog.record_log(conn, str(tmp_path / f"log{i}.feather"), df)
+    return WorkQueue(db_path, str(tmp_path))
+
+
+def test_leased_is_not_done(tmp_path):
+    queue = make_queue(tmp_path, 2)
+    first, second = queue.take(), queue.take()
+    assert queue.take() is None
+    assert queue.leased() == 2
+    queue.complete(first, "someone")
+    assert queue.leased() == 1
+    queue.release_all()
+    assert queue.leased() == 0
+    assert queue.take() == second
+
+
+def test_close_gives_logs_back(tmp_path):
+    queue = make_queue(tmp_path, 3)
+    pool = PrefetchPool(
+        queue.take,
+        queue.release,
+        lambda path: pd.DataFrame({"x": [1]}),
+        queue.fail,
+        size=2,
+    )
+    pool.start()
+    deadline = time.time() + 5
+    while len(pool) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(pool) == 2
+    pool.close()
+    pool.worker.join(5)
+    assert not pool.worker.is_alive()
+    assert len(pool) == 0
+    assert queue.leased() == 0
+    assert len(queue) == 3
+
+
+def test_unreadable_log_is_dropped(tmp_path):
+    queue = make_queue(tmp_path, 2)
+
+    def load(path):
+        if path.endswith("log0.feather"):
+            raise OSError("truncated")
+        return pd.DataFrame({"x": [1]})
+
+    # the pool is not started, logs are parsed by get
+    pool = PrefetchPool(queue.take, queue.release, load, queue.fail)
+    paths = []
+    for _ in range(2):
+        try:
+            paths.append(pool.get()[1])
+        except OSError:
+            pass
+    assert paths == [str(tmp_path / "log1.feather")]
+    assert queue.leased() == 1
+    assert len(queue) == 0
+    assert queue.leases.keys() == {paths[0]}
+
+    # converting the log again puts it back in the queue
+    conn = catalog.connect(str(tmp_path / "catalog.sqlite"))
+    catalog.record_log(conn, str(tmp_path / "log0.feather"), pd.DataFrame())
+    assert len(queue) == 1
+
+
+def test_expired_prefetch_lease_is_lost(tmp_path):
+    queue = make_queue(tmp_path, 1)
+    other = WorkQueue(queue.db_path, queue.csv_dir)
+    # a prefetched log whose short lease expired goes back to the queue
+    path = queue.take(lease_s=-1)
+    assert queue.leased() == 0
+    assert other.take() == path
+    assert not queue.renew(path)
+    queue.release(path)
+    assert other.renew(path)
+    assert queue.leased() == 1